@@ -0,0 +1,94 @@
+"""
+A process wide memory budget for decoded source images.
+
+Every render admits the estimated size of the decoded source image, its pixel
+count times four bytes, against the ``CROPPY_MEMORY_BUDGET`` setting (in
+bytes, default ``None`` meaning unlimited) before decoding it, and releases it
+once its crops are written. Renders that would exceed the budget wait until
+enough memory is released. The ``CROPPY_MEMORY_TIMEOUT`` setting limits the
+wait in seconds, after which :attr:`MemoryBudgetExceeded` is raised. It
+defaults to ``None``, waiting for as long as it takes; ``0`` rejects renders
+right away.
+
+A source larger than the whole budget is admitted once nothing else is being
+rendered.
+
+Time spent waiting is reported as the ``admission`` stage of the render's
+:attr:`croppy.stats.Timer`, rejections as the ``croppy.budget.rejected``
+counter.
+"""
+from contextlib import contextmanager
+from croppy import stats
+from django.conf import settings
+import threading
+import time
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+_condition = threading.Condition()
+_admitted = 0
+
+def get_budget():
+    """
+    Return the memory budget in bytes, ``None`` if unlimited.
+    """
+    return getattr(settings, 'CROPPY_MEMORY_BUDGET', None)
+
+def get_timeout():
+    """
+    Return the number of seconds to wait for memory, ``None`` to wait forever.
+    """
+    return getattr(settings, 'CROPPY_MEMORY_TIMEOUT', None)
+
+def get_admitted():
+    """
+    Return the number of bytes currently admitted.
+    """
+    return _admitted
+
+@contextmanager
+def admit(estimate, timer=None):
+    """
+    Admit a render against the budget for the duration of the ``with`` block.
+    ``estimate`` is a function returning the render's size in bytes. It is
+    only called if a budget is configured, as estimating may need to read the
+    source image's header.
+    """
+    global _admitted
+    budget = get_budget()
+
+    if not budget:
+        yield
+        return
+
+    timer = timer or stats.Timer()
+    size = min(estimate(), budget)
+    timeout = get_timeout()
+    started = time.time()
+
+    with _condition:
+        while _admitted + size > budget:
+            remaining = None if timeout is None else started + timeout - time.time()
+
+            if remaining is not None and remaining <= 0:
+                sink = stats.get_sink()
+                if sink is not None:
+                    sink.incr('croppy.budget.rejected')
+                raise MemoryBudgetExceeded("Rendering needs %d bytes, %d of %d "
+                    "are in use." % (size, _admitted, budget))
+
+            _condition.wait(remaining)
+
+        _admitted += size
+
+    timer.add('admission', time.time() - started)
+
+    try:
+        yield
+    finally:
+        with _condition:
+            _admitted -= size
+            _condition.notify_all()
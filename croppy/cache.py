@@ -0,0 +1,155 @@
+"""
+Cached storage metadata.
+
+On remote storage backends, building a crop's URL, checking that its file
+exists or getting its size or modification time costs a network round trip
+each. When the ``CROPPY_CACHE`` setting names one of the ``CACHES``,
+:attr:`CropField` caches these answers for ``CROPPY_CACHE_TIMEOUT`` seconds
+(default ``3600``) and drops them whenever croppy writes or deletes a file, so
+listing many crops does no storage I/O once their metadata is cached::
+
+    CACHES = {
+        'default': {...},
+        'croppy': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': '127.0.0.1:11211',
+        },
+    }
+    CROPPY_CACHE = 'croppy'
+
+If your backend signs URLs, keep the timeout below their expiry. Files changed
+in storage other than through croppy are only picked up once their cached
+metadata expires.
+
+The same cache, or the ``default`` one without the setting, holds the locks
+taken with :attr:`lock`. Use a cache shared by all processes for them to
+exclude each other.
+"""
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils.encoding import smart_str
+import hashlib
+import time
+
+try:
+    from django.core.cache import caches
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
+
+
+def get_timeout():
+    """
+    Return the number of seconds metadata is cached for.
+    """
+    return getattr(settings, 'CROPPY_CACHE_TIMEOUT', 3600)
+
+@contextmanager
+def lock(name, timeout=60):
+    """
+    Hold the lock ``name`` for the duration of the ``with`` block, waiting 
+    for other holders to release it. Locks expire after ``timeout`` seconds, 
+    so a crashed holder can't block others forever.
+    """
+    cache = get_cache(getattr(settings, 'CROPPY_CACHE', None) or 'default')
+    key = 'croppy.lock.%s' % hashlib.md5(smart_str(name)).hexdigest()
+
+    while not cache.add(key, 1, timeout):
+        time.sleep(0.05)
+
+    try:
+        yield
+    finally:
+        cache.delete(key)
+
+class CachedStorage(object):
+    """
+    Wraps a storage backend, caching the results of :attr:`url`,
+    :attr:`exists`, :attr:`size` and :attr:`modified_time` in the cache
+    named by ``CROPPY_CACHE``. Without the setting, and for all other methods,
+    calls are passed through to the wrapped ``storage``.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        if name == 'storage':
+            raise AttributeError(name)
+
+        attr = getattr(self.storage, name)
+
+        if name == 'delete_many':
+            # Only offered if the wrapped backend has it
+            def delete_many(names):
+                attr(names)
+                self.invalidate(names)
+            return delete_many
+
+        return attr
+
+    def get_cache(self):
+        alias = getattr(settings, 'CROPPY_CACHE', None)
+        return None if alias is None else get_cache(alias)
+
+    def get_key(self, name):
+        storage = type(self.storage)
+        return 'croppy.storage.%s' % hashlib.md5(smart_str('%s.%s:%s' % (
+            storage.__module__, storage.__name__, name))).hexdigest()
+
+    def get_cached(self, method, name):
+        """
+        Return the cached result of calling ``method`` of the wrapped storage
+        with ``name``, calling it on a cache miss. All results for a file are
+        stored under one key.
+        """
+        cache = self.get_cache()
+
+        if cache is None:
+            return getattr(self.storage, method)(name)
+
+        key = self.get_key(name)
+        values = cache.get(key) or {}
+
+        if method not in values:
+            values[method] = getattr(self.storage, method)(name)
+            cache.set(key, values, get_timeout())
+
+        return values[method]
+
+    def invalidate(self, names):
+        """
+        Drop the cached metadata of the named files.
+        """
+        cache = self.get_cache()
+
+        if cache is not None:
+            cache.delete_many([self.get_key(name) for name in names])
+
+    def url(self, name):
+        return self.get_cached('url', name)
+
+    def exists(self, name):
+        return self.get_cached('exists', name)
+
+    def size(self, name):
+        return self.get_cached('size', name)
+
+    def modified_time(self, name):
+        return self.get_cached('modified_time', name)
+
+    def save(self, name, content, *args, **kwargs):
+        name = self.storage.save(name, content, *args, **kwargs)
+        self.invalidate([name])
+        return name
+
+    def _save(self, name, content):
+        name = self.storage._save(name, content)
+        self.invalidate([name])
+        return name
+
+    def delete(self, name):
+        self.storage.delete(name)
+        self.invalidate([name])
@@ -0,0 +1,500 @@
+"""
+Image processing engines crops are opened, cut, resized and encoded with.
+
+The engine is chosen with the ``engine`` argument of :attr:`CropField` or the
+``CROPPY_ENGINE`` setting, a dotted path to a :attr:`BaseEngine` subclass. It
+defaults to :attr:`PILEngine`.
+
+:attr:`VipsEngine` uses `libvips <https://libvips.github.io/libvips/>`_
+through the optional ``pyvips`` package (``pip install django-croppy[vips]``).
+The source is streamed from storage and decoded while the crops are being
+encoded, without buffering the whole file first::
+
+    class Photo(models.Model):
+        image = models.ImageField(upload_to='photos')
+        crops = CropField('image', engine='croppy.engines.VipsEngine')
+"""
+from croppy import stats
+from croppy.utils import import_by_path
+from django.conf import settings
+from imagekit.lib import Image, StringIO
+from imagekit.processors import ProcessorPipeline
+from imagekit.utils import (img_to_fobj, open_image, extension_to_format,
+    format_to_extension, UnknownExtensionError)
+import os
+import threading
+import time
+
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+
+#: Formats :attr:`PILEngine` tries to decode partially.
+REGION_FORMATS = ('TIFF',)
+
+#: Image metadata dropped from crops unless ``strip_metadata`` is ``False``.
+METADATA_KEYS = ('exif', 'icc_profile')
+
+#: File extensions of crops encoded in the given formats. PIL registers 
+#: several extensions per format and which one it returns first depends on
+#: the plugins loaded, so they are spelled out.
+EXTENSIONS = {
+    'BMP': '.bmp',
+    'GIF': '.gif',
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'TIFF': '.tiff',
+    'WEBP': '.webp',
+}
+
+
+class BaseEngine(object):
+    """
+    Engines work on their own image objects, which are only handed back to
+    them. Boxes are ``(x, y, width, height)`` tuples, sizes ``(width,
+    height)`` tuples.
+    """
+    #: Whether images can be sent to process pools, see :mod:`croppy.workers`.
+    picklable = True
+
+    def open(self, fp, reduction=1, box=None, timer=None, reopen=None):
+        """
+        Open the image in the file object ``fp``. Engines may decode on demand,
+        so ``fp`` has to stay open until all crops were encoded.
+
+        :param reduction: Factor the image may be reduced by while decoding.
+        :param box: ``(x0, y0, x1, y1)`` bounding box of all crops to be cut
+            from the image. Engines may decode only that part of the image.
+        :param timer: :attr:`croppy.stats.Timer` to record the ``read`` and
+            ``decode`` stages and ``bytes_read`` counter with.
+        :param reopen: Function returning a new file object for the same file,
+            for engines reading from several threads. Files it returns are
+            closed together with ``fp``.
+        :returns: 3-tuple of the image, the ``(x, y)`` factors it was reduced
+            by and the ``(x, y)`` offset of the decoded part in the file's
+            image.
+        """
+        raise NotImplementedError
+
+    def load(self, img):
+        """
+        Return the image fully decoded, so its file can be closed.
+        """
+        return img
+
+    def copy(self, img):
+        """
+        Return a plain in-memory copy of the decoded image, to be pickled to
+        process pool workers.
+        """
+        return img
+
+    def get_decoded_size(self, opener, size, format, reduction=1, box=None):
+        """
+        Return the ``(width, height)`` of what :attr:`open` decodes with the 
+        given ``reduction`` and ``box`` from a source image of the given
+        ``size`` and ``format``, to estimate its memory footprint. ``opener``
+        returns the source's file object if the header is needed. 
+
+        By default JPEG sources are assumed to be reduced and others to be
+        decoded in full.
+        """
+        width, height = size
+
+        if format == 'JPEG' and reduction > 1:
+            return -(-width // reduction), -(-height // reduction)
+
+        return width, height
+
+    def get_size(self, img):
+        raise NotImplementedError
+
+    def get_format(self, img):
+        """
+        Return the PIL name of the format the image was read from, e.g.
+        ``'JPEG'``, or ``None``.
+        """
+        raise NotImplementedError
+
+    def crop(self, img, box):
+        raise NotImplementedError
+
+    def resize(self, img, size):
+        raise NotImplementedError
+
+    def crop_resize(self, img, box, size):
+        return self.resize(self.crop(img, box), size)
+
+    def process(self, img, processors):
+        """
+        Apply the crop processors returned by
+        :attr:`CropFieldDescriptor.get_processors`.
+        """
+        from croppy.fields import CropResize
+
+        for processor in processors:
+            box = (processor.x, processor.y, processor.width, processor.height)
+
+            if isinstance(processor, CropResize):
+                img = self.crop_resize(img, box, processor.size)
+            else:
+                img = self.crop(img, box)
+
+        return img
+
+    def encode(self, img, format, options=None, source=None):
+        """
+        Return the image encoded in the given format with the encoding options
+        described in :attr:`CropField`. ``source`` is the image read from the
+        file, to copy metadata from.
+        """
+        raise NotImplementedError
+
+class PILEngine(BaseEngine):
+    """
+    Renders crops with PIL and imagekit processors. Tiled and striped TIFF
+    sources are only decoded in the tiles intersecting the crops and JPEG
+    sources are decoded with PIL's draft mode (DCT scaling) when they can be
+    reduced.
+    """
+    def open(self, fp, reduction=1, box=None, timer=None, reopen=None):
+        timer = timer or stats.Timer()
+
+        if box is not None and get_format(getattr(fp, 'name', None)) in REGION_FORMATS:
+            # Tiles are read while decoding, tell both stages apart
+            timed, started = stats.TimedFile(fp, timer), time.time()
+            img = open_image(timed)
+            offset = load_region(img, box)
+            timer.add('decode', time.time() - started - timed.seconds)
+
+            if offset is not None:
+                timer.incr('regions')
+                return img, (1, 1), offset
+
+            fp.seek(0)
+
+        with timer('read'):
+            data = fp.read()
+
+        timer.incr('bytes_read', len(data))
+
+        with timer('decode'):
+            img = open_image(StringIO(data))
+            width, height = img.size
+
+            if reduction > 1 and img.format == 'JPEG':
+                img.draft(img.mode, (width // reduction, height // reduction))
+
+            img.load()
+
+        return img, (float(width) / img.size[0], float(height) / img.size[1]), (0, 0)
+
+    def copy(self, img):
+        # Plugin image classes like ``TiffImageFile`` don't survive pickling
+        return img.copy()
+
+    def get_decoded_size(self, opener, size, format, reduction=1, box=None):
+        if box is None or format not in REGION_FORMATS:
+            return super(PILEngine, self).get_decoded_size(opener, size, format,
+                reduction, box)
+
+        # Only the header is read to find the tiles load_region() decodes
+        fp = opener()
+        try:
+            tiles = get_tiles(open_image(fp), box)
+        finally:
+            fp.close()
+
+        if not tiles:
+            return size
+
+        return (max(tile[1][2] for tile in tiles) - min(tile[1][0] for tile in tiles),
+            max(tile[1][3] for tile in tiles) - min(tile[1][1] for tile in tiles))
+
+    def get_size(self, img):
+        return img.size
+
+    def get_format(self, img):
+        return img.format
+
+    def crop(self, img, box):
+        x, y, width, height = box
+        return img.crop((x, y, x + width, y + height))
+
+    def resize(self, img, size):
+        return img.resize(tuple(size), Image.ANTIALIAS)
+
+    def crop_resize(self, img, box, size):
+        from croppy.fields import CropResize
+
+        return CropResize(*box, size=size).process(img)
+
+    def process(self, img, processors):
+        return ProcessorPipeline(processors).process(img)
+
+    def encode(self, img, format, options=None, source=None):
+        kwargs = get_save_options(source or img, options)
+
+        # Some savers, e.g. PNG's, fall back to the metadata in ``img.info``
+        for key in METADATA_KEYS:
+            if key not in kwargs:
+                img.info.pop(key, None)
+
+        return img_to_fobj(img, format, **kwargs).read()
+
+class VipsEngine(BaseEngine):
+    """
+    Renders crops with libvips. Sources are streamed from storage and
+    decoded on demand, and JPEG sources are shrunk while decoding when they
+    can be reduced. Crops are cut from the region covering them, but whether
+    pixels outside of it are decoded depends on the loader: tiled TIFFs are
+    only read in the tiles needed, while JPEG and PNG sources are decoded in
+    full when random access is needed. Requires ``pyvips``.
+
+    Encoding options are mapped to libvips savers: ``quality`` to ``Q``,
+    ``progressive`` to ``interlace``, ``optimize`` to ``optimize_coding``
+    and ``strip_metadata`` to ``strip``.
+    """
+    picklable = False
+
+    #: Maps libvips loaders to PIL format names.
+    LOADERS = {
+        'jpegload': 'JPEG',
+        'pngload': 'PNG',
+        'tiffload': 'TIFF',
+        'webpload': 'WEBP',
+        'gifload': 'GIF',
+    }
+
+    def __init__(self):
+        assert pyvips is not None, "VipsEngine requires the 'pyvips' package."
+
+    def open(self, fp, reduction=1, box=None, timer=None, reopen=None):
+        timer = timer or stats.Timer()
+
+        # Only the header is decoded here, pixels are decoded when encoding.
+        # Reads are recorded by the source, keep them out of ``decode``.
+        started, read = time.time(), timer.timings.get('read', 0)
+
+        img = pyvips.Image.new_from_source(self.get_source(fp, timer, reopen), 
+            '', access='random')
+        width, height = img.width, img.height
+
+        if reduction > 1 and self.get_format(img) == 'JPEG':
+            img = pyvips.Image.new_from_source(self.get_source(fp, timer,
+                reopen), '', access='random', shrink=reduction)
+
+        timer.add('decode', time.time() - started 
+            - (timer.timings.get('read', 0) - read))
+
+        scale = (float(width) / img.width, float(height) / img.height)
+        offset = (0, 0)
+
+        if box is not None:
+            x0, y0 = int(box[0] / scale[0]), int(box[1] / scale[1])
+            x1 = int(-(-box[2] // scale[0]))
+            y1 = int(-(-box[3] // scale[1]))
+            x0, y0 = max(x0, 0), max(y0, 0)
+            x1, y1 = min(x1, img.width), min(y1, img.height)
+
+            if x0 < x1 and y0 < y1:
+                img, offset = img.extract_area(x0, y0, x1 - x0, y1 - y0), (x0, y0)
+
+        return img, scale, offset
+
+    def get_source(self, fp, timer, reopen=None):
+        """
+        Return a libvips source streaming from the file object ``fp``. libvips
+        may read from any thread, so each thread reads through its own file
+        object from ``reopen`` if given, at the position the source is at.
+        """
+        lock = threading.Lock()
+        local = threading.local()
+        owner = threading.current_thread()
+        position = [0]
+
+        def get_fp():
+            if not hasattr(local, 'fp'):
+                use_fp = reopen is None or threading.current_thread() is owner
+                local.fp = fp if use_fp else reopen()
+            return local.fp
+
+        def read(size):
+            with lock:
+                started = time.time()
+                handle = get_fp()
+                handle.seek(position[0])
+                data = handle.read(size)
+                position[0] += len(data)
+            timer.add('read', time.time() - started)
+            timer.incr('bytes_read', len(data))
+            return data
+
+        def seek(offset, whence):
+            with lock:
+                if whence == os.SEEK_SET:
+                    position[0] = offset
+                elif whence == os.SEEK_CUR:
+                    position[0] += offset
+                else:
+                    handle = get_fp()
+                    handle.seek(offset, whence)
+                    position[0] = handle.tell()
+                return position[0]
+
+        source = pyvips.SourceCustom()
+        source.on_read(read)
+        source.on_seek(seek)
+        return source
+
+    def load(self, img):
+        return img.copy_memory()
+
+    def get_size(self, img):
+        return img.width, img.height
+
+    def get_format(self, img):
+        try:
+            loader = img.get('vips-loader')
+        except pyvips.Error:
+            return None
+        return self.LOADERS.get(loader.split('_')[0])
+
+    def crop(self, img, box):
+        # Clamp to the image and pad with black like PIL does
+        x, y, width, height = box
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, img.width), min(y + height, img.height)
+
+        if x0 >= x1 or y0 >= y1:
+            return pyvips.Image.black(width, height, bands=img.bands).cast(
+                img.format).copy(interpretation=img.interpretation)
+
+        img = img.extract_area(x0, y0, x1 - x0, y1 - y0)
+
+        if (x0, y0, x1, y1) != (x, y, x + width, y + height):
+            img = img.embed(x0 - x, y0 - y, width, height, extend='black')
+
+        return img
+
+    def resize(self, img, size):
+        width, height = size
+        return img.resize(float(width) / img.width,
+            vscale=float(height) / img.height)
+
+    def encode(self, img, format, options=None, source=None):
+        options = options or {}
+        kwargs = dict(strip=options.get('strip_metadata', True))
+
+        if options.get('quality') is not None:
+            kwargs['Q'] = options['quality']
+        if options.get('progressive'):
+            kwargs['interlace'] = True
+        if options.get('optimize') and format == 'JPEG':
+            kwargs['optimize_coding'] = True
+
+        return img.write_to_buffer(get_extension(format), **kwargs)
+
+
+_engines = {}
+_lock = threading.Lock()
+
+def get_engine(engine=None):
+    """
+    Return the engine given by a dotted path, falling back to the
+    ``CROPPY_ENGINE`` setting. Engines are created once per path and shared.
+    Engine instances are returned as they are.
+    """
+    engine = engine or getattr(settings, 'CROPPY_ENGINE', 'croppy.engines.PILEngine')
+
+    if not isinstance(engine, basestring):
+        return engine
+
+    with _lock:
+        if engine not in _engines:
+            _engines[engine] = import_by_path(engine)()
+        return _engines[engine]
+
+def get_format(filename):
+    """
+    Guess a PIL format name from a filename's extension, ``None`` if unknown.
+    """
+    extension = os.path.splitext(filename or '')[1].lower()
+
+    if extension:
+        try:
+            return extension_to_format(extension)
+        except UnknownExtensionError:
+            pass
+
+def get_extension(format):
+    """
+    Return the file extension for a PIL format name, e.g. ``'.jpg'`` for
+    ``'JPEG'``, see :attr:`EXTENSIONS`.
+    """
+    format = format.upper()
+    return EXTENSIONS.get(format) or format_to_extension(format)
+
+def get_save_options(img, options):
+    """
+    Turn encoding options into keyword arguments for PIL's ``Image.save``.
+    Unless ``strip_metadata`` is ``False``, EXIF data and ICC profiles of the
+    source image ``img`` are not carried over to the crop.
+    """
+    options = dict(options or {})
+    options.pop('format', None)
+
+    if not options.pop('strip_metadata', True):
+        for key in METADATA_KEYS:
+            if key in img.info:
+                options[key] = img.info[key]
+
+    return options
+
+def load_region(img, box):
+    """
+    Decode only the tiles or strips of the opened, not yet loaded image ``img``
+    intersecting ``box``, an ``(x0, y0, x1, y1)`` rectangle. The image is
+    shrunk to the bounding box of those tiles.
+
+    Returns the ``(x, y)`` offset of the decoded region in the source image,
+    or ``None`` if the image is decoded in one piece and can't be partially
+    loaded, e.g. compressed TIFF read through libtiff, or if ``box`` lies
+    outside the image.
+    """
+    tiles = get_tiles(img, box)
+
+    if not tiles:
+        return None
+
+    left = min(tile[1][0] for tile in tiles)
+    top = min(tile[1][1] for tile in tiles)
+    right = max(tile[1][2] for tile in tiles)
+    bottom = max(tile[1][3] for tile in tiles)
+
+    img.tile = [(decoder, (e0 - left, e1 - top, e2 - left, e3 - top), offset, args)
+        for decoder, (e0, e1, e2, e3), offset, args in tiles]
+
+    # Pillow keeps the size in a private attribute behind a read-only property
+    if hasattr(img, '_size'):
+        img._size = (right - left, bottom - top)
+    else:
+        img.size = (right - left, bottom - top)
+
+    img.load()
+    return left, top
+
+def get_tiles(img, box):
+    """
+    Return the tiles or strips of the opened, not yet loaded image ``img``
+    intersecting ``box``, an ``(x0, y0, x1, y1)`` rectangle, see 
+    :attr:`load_region`. Returns an empty list for images decoded in one piece.
+    """
+    if len(img.tile) < 2:
+        return []
+
+    x0, y0, x1, y1 = box
+    return [tile for tile in img.tile if tile[1][0] < x1 and tile[1][2] > x0
+        and tile[1][1] < y1 and tile[1][3] > y0]
@@ -1,12 +1,19 @@
+from contextlib import contextmanager
 from django.core.exceptions import ValidationError
 from django.core.files.storage import DefaultStorage
+from django.db.models import Q, signals as model_signals
 from django.db.models.fields import TextField
 from django.db.models.fields.files import ImageFieldFile
 from django.template.defaultfilters import slugify 
-from imagekit.generators import SpecFileGenerator
-from imagekit.processors.resize import Resize
+from imagekit.lib import Image
+from imagekit.utils import IKContentFile
+from croppy import budget, cache, engines, queues, signals, stats, workers
+import django
+import hashlib
+import json
 import jsonfield
 import os
+import time
 
 
 
@@ -21,6 +28,120 @@ class Crop(object):
         return img.crop((self.x, self.y, self.x + self.width, self.y + self.height))
 
 
+class CropResize(Crop):
+    """
+    Crops and resizes in one go. The output is resampled straight from the
+    source region instead of materializing the cropped image first and then
+    resampling that. Boxes reaching past the source image's edges are cropped
+    first, so they are padded like :attr:`Crop` pads them.
+    """
+    def __init__(self, x=None, y=None, width=None, height=None, size=None):
+        super(CropResize, self).__init__(x, y, width, height)
+        self.size = tuple(size)
+
+    def process(self, img):
+        box = (self.x, self.y, self.x + self.width, self.y + self.height)
+        width, height = img.size
+
+        if box[0] >= 0 and box[1] >= 0 and box[2] <= width and box[3] <= height:
+            # ``reducing_gap`` needs Pillow 7, ``box`` Pillow 3.4
+            for kwargs in (dict(box=box, reducing_gap=3.0), dict(box=box)):
+                try:
+                    return img.resize(self.size, Image.ANTIALIAS, **kwargs)
+                except TypeError:
+                    pass
+
+        return img.crop(box).resize(self.size, Image.ANTIALIAS)
+
+
+def render(job):
+    """
+    Run the processors on a decoded image and encode the result. ``job`` is a
+    5-tuple of ``(engine, img, processors, format, options)`` so this function
+    can be mapped over a :attr:`croppy.workers` pool. ``options`` are the 
+    encoding options described in :attr:`CropField`.
+
+    Returns a 3-tuple of the encoded bytes, the output ``(width, height)`` and
+    a dictionary with the seconds spent in the ``process`` and ``encode`` 
+    stages.
+    """
+    engine, img, processors, format, options = job
+
+    started = time.time()
+    crop = engine.process(img, processors)
+    processed = time.time()
+    data = engine.encode(crop, format, options, img)
+
+    return data, engine.get_size(crop), dict(process=processed - started, 
+        encode=time.time() - processed)
+
+def render_variants(job):
+    """
+    Render a crop at several widths. ``job`` is a 6-tuple of ``(engine, img, 
+    processors, widths, format, options)``. The processors cut the crop 
+    region from the decoded image once, then each width is resampled from the
+    previous, larger one.
+
+    Returns a list of 3-tuples as described in :attr:`render`, ordered by 
+    descending width.
+    """
+    engine, img, processors, widths, format, options = job
+    started = time.time()
+    region = engine.process(img, processors)
+    rendered = []
+
+    for width in sorted(widths, reverse=True):
+        region_width, region_height = engine.get_size(region)
+        height = int(round(region_height * float(width) / region_width))
+        region = engine.resize(region, (width, height))
+        processed = time.time()
+        data = engine.encode(region, format, options, img)
+        encoded = time.time()
+
+        rendered.append((data, (width, height), dict(process=processed - started,
+            encode=encoded - processed)))
+        started = encoded
+
+    return rendered
+
+def get_filenames(spec):
+    """
+    Return the names of all files of a crop spec, including its variants.
+    """
+    return [spec['filename']] + [variant['filename'] 
+        for variant in spec.get('variants', [])]
+
+#: Key the source pyramid is stored under in the crop data, see 
+#: :attr:`CropFieldDescriptor.pyramid`.
+PYRAMID_KEY = '_pyramid'
+
+#: Number of hex digits of the version embedded in versioned filenames.
+VERSION_LENGTH = 8
+
+#: Version of the compact serialization, see :attr:`CropField`.
+COMPACT_VERSION = 1
+
+#: Key the compact serialization stores its version under.
+COMPACT_VERSION_KEY = '_v'
+
+#: Spec keys stored positionally in the compact serialization.
+COMPACT_KEYS = ('x', 'y', 'width', 'height', 'resize', 'output_width', 
+    'output_height', 'size', 'format', 'fingerprint', 'filename')
+
+def get_variant_filename(filename, width, version=None):
+    """
+    Return the filename a variant of the given width is derived from the 
+    crop's ``filename`` in the compact serialization, e.g. 
+    ``crops/image-thumbnail_50w.5d41402a.png``. 
+    """
+    root, ext = os.path.splitext(filename)
+    suffix = ''
+
+    if version and root.endswith('.' + version):
+        root, suffix = root[:-len(version) - 1], '.' + version
+
+    return '%s_%dw%s%s' % (root, width, suffix, ext)
+
 def upload_to(instance, filename, crop_name):
     """
     Default function to specify a location to save crops to.
@@ -37,11 +158,114 @@ class CropFieldFile(ImageFieldFile):
     """
     :attr:`CropFieldFile` objects are attached to a model's crop descriptor for each 
     specified crop spec.
+
+    Crops created by :attr:`CropFieldDescriptor.create` record their output
+    dimensions, byte size and format in the spec, so :attr:`width`, 
+    :attr:`height`, :attr:`size` and :attr:`format` are answered without 
+    touching storage. URLs can be cached, see :mod:`croppy.cache`.
     """
     def __init__(self, crop_name, spec, *args, **kwargs):
         self.crop_name = crop_name
         self.spec = spec
         super(CropFieldFile, self).__init__(*args, **kwargs)
+
+    @property
+    def width(self):
+        if 'output_width' in self.spec:
+            return self.spec['output_width']
+        return super(CropFieldFile, self).width
+
+    @property
+    def height(self):
+        if 'output_height' in self.spec:
+            return self.spec['output_height']
+        return super(CropFieldFile, self).height
+
+    @property
+    def size(self):
+        if 'size' in self.spec:
+            return self.spec['size']
+        return super(CropFieldFile, self).size
+
+    @property
+    def format(self):
+        """
+        The image format the crop was encoded in, e.g. ``'JPEG'``. ``None`` for
+        crops created before the format was recorded.
+        """
+        return self.spec.get('format')
+
+    @property
+    def pending(self):
+        """
+        ``True`` while a crop created with ``defer=True`` waits to be rendered.
+        """
+        return self.spec.get('pending', False)
+
+    @property
+    def ready(self):
+        """
+        ``True`` once the crop file was rendered.
+        """
+        return not self.pending
+
+    @property
+    def variants(self):
+        """
+        List of the crop's width variants as dictionaries with ``width``, 
+        ``height``, ``filename`` and ``size`` keys, ordered by descending 
+        width. See the ``variants`` parameter of 
+        :attr:`CropFieldDescriptor.create`.
+        """
+        return self.spec.get('variants', [])
+
+    @property
+    def srcset(self):
+        """
+        A ``srcset`` attribute value listing the crop's width variants::
+
+            <img src="{{ image.crops.hero.url }}" 
+                srcset="{{ image.crops.hero.srcset }}">
+        """
+        return ', '.join('%s %dw' % (self.storage.url(variant['filename']), 
+            variant['width']) for variant in reversed(self.variants))
+
+    @property
+    def version(self):
+        """
+        The version embedded in the crop's filenames if the field is 
+        versioned, see :attr:`CropField`, otherwise ``None``.
+        """
+        return self.spec.get('version')
+
+    @property
+    def filenames(self):
+        """
+        Names of all files belonging to this crop, including its variants.
+        """
+        return get_filenames(self.spec)
+
+    @property
+    def view_url(self):
+        """
+        URL of :attr:`croppy.views.crop` serving this crop, rendering it first
+        if needed. Requires ``croppy.urls`` to be included in your URLconf.
+        Versioned crops carry their :attr:`version` in the query string and
+        are served as immutable.
+        """
+        from django.core.urlresolvers import reverse
+
+        url = reverse('croppy_crop', kwargs=dict(
+            app_label=self.instance._meta.app_label,
+            model_name=self.instance._meta.object_name.lower(),
+            pk=self.instance.pk,
+            field_name=self.field.name,
+            crop_name=self.crop_name))
+
+        if self.version:
+            url = '%s?v=%s' % (url, self.version)
+
+        return url
        
     def delete(self, save=True):
         """
@@ -54,31 +278,99 @@ class CropFieldFile(ImageFieldFile):
         :param save: When true, the instance is saved to the database after 
             the crop was deleted.
         """
-        if hasattr(self, '_file'):
-            self.close()
-            del self.file
+        self.release()
 
-        self.storage.delete(self.name)
+        for name in self.filenames:
+            self.storage.delete(name)
         
         if save:
-            self.instance.save()
+            getattr(self.instance, self.field.name).save_instance()
         
         self._commited = False
 
+    def release(self):
+        """
+        Close and forget the underlying file if it was opened.
+        """
+        if hasattr(self, '_file'):
+            self.close()
+            del self.file
+
 class CropFieldDescriptor(object):
     """
     Crop descriptors are created by :attr:`CropField` and allow for creating, 
     inspecting and deleting crops.  
+
+    Descriptors are lazy: the raw column value is only deserialized when 
+    :attr:`data` is first accessed and :attr:`CropFieldFile` objects are only 
+    created when a crop attribute is first looked up.
     """
     def __init__(self, instance, field, data):
         self.instance = instance
         self.field = field
-        self.image = getattr(instance, field.image_field)
         
-        self._data = {}
-        self.data = data        
+        self._raw = data
+        self._data = None
+        self._pyramid = []
+
+        self._source_name = None
+        self._source_changed = False
+
+        self._batch = 0
+        self._dirty = False
+        self._queued = []
+
+    @property
+    def image(self):
+        """
+        The :attr:`ImageFieldFile` crops are created from.
+        """
+        return getattr(self.instance, self.field.image_field)
+
+    @contextmanager
+    def batch(self):
+        """
+        Defer saving the model instance until the end of the block, where the
+        crop data is written once if any crop was created or deleted. Crops
+        created with ``defer=True`` are queued after that save::
+
+            >>> with image.crops.batch():
+            ...     image.crops.create('square', (0, 0, 100, 100))
+            ...     image.crops.delete('banner')
+        """
+        self._batch += 1
+        try:
+            yield self
+        finally:
+            self._batch -= 1
+
+            if not self._batch:
+                if self._dirty:
+                    self._dirty = False
+                    self.save_instance()
+
+                if self._queued:
+                    queues.enqueue(self, self._queued)
+                    self._queued = []
+
+    def save_instance(self):
+        """
+        Save the crop data to the database. Only the crop field's column is 
+        written, so other columns are left alone and ``auto_now`` fields are
+        not touched. Instances that were never saved and Django versions 
+        before 1.5 fall back to a full save. Inside :attr:`batch` saving is
+        deferred until the end of the block.
+        """
+        if self._batch:
+            self._dirty = True
+        elif self.instance.pk is None or self.instance._state.adding or \
+                django.VERSION < (1, 5):
+            self.instance.save()
+        else:
+            self.instance.save(update_fields=[self.field.name])
 
-    def create(self, name, spec, resize=None, save=True):
+    def create(self, name, spec, resize=None, save=True, defer=False, 
+        force=False, lazy=False, options=None, variants=None):
         """
         Create a new crop with the provided spec. For example the following code
         creates a crop of the original image starting at the X/Y coordinates of 
@@ -95,40 +387,826 @@ class CropFieldDescriptor(object):
         
         Note that you should keep the ratio of width to height when resizing or 
         you'll end up with warped images.
+
+        Rendering can be handed to a background queue, see 
+        :mod:`croppy.queues`. The crop's spec is recorded right away and the 
+        crop is marked as pending until it was rendered::
+
+            >>> image.crops.create('thumbnail', crop, defer=True).pending
+            True
+
+        Creating a crop that exists already replaces it. Its files are only 
+        deleted once the new crop was recorded, so a failed render, e.g. one
+        rejected by the :mod:`croppy.budget`, leaves the existing crop alone.
                                          
         :param name: Crop name. This must be unique and is also used to generate
             the filename.
         :param spec: 4-tuple containing ``(x, y, width, height)``
         :param resize: 2-tuple for resizing the crop containing ``(width, height)``
         :param save: Boolean, if specified the model is saved back to DB after the crop.
+        :param defer: Boolean, if specified the crop is rendered by the queue 
+            backend instead of inline. The queue loads the instance from the 
+            database, so when not saving here, save before it gets to run.
+        :param force: Boolean, if specified the crop is rendered even if an
+            identical crop exists already. Otherwise creating a crop whose 
+            :attr:`get_fingerprint` did not change is a no-op.
+        :param lazy: Boolean, if specified only the spec is recorded and the 
+            crop is marked as pending. It is rendered on its first request 
+            through :attr:`croppy.views.crop`, see :attr:`CropFieldFile.view_url`.
+        :param options: Dictionary of encoding options, overriding the ones
+            given to :attr:`CropField`::
+
+                >>> image.crops.create('thumbnail', crop, 
+                ...     options={'format': 'WEBP', 'quality': 80})
+        :param variants: List of widths to additionally render the crop at, 
+            e.g. for responsive images. All variants are resampled from one
+            crop of the source image, largest first, and stored with the crop,
+            see :attr:`CropFieldFile.srcset`::
+
+                >>> image.crops.create('hero', crop, variants=[480, 960, 1440])
         """
         name = self.validate_name(name)
+        return self.create_many({name: (spec, resize)}, save=save, 
+            defer=defer, force=force, lazy=lazy, options=options, 
+            variants=variants)[name]
+
+    def create_many(self, crops, save=True, defer=False, force=False, 
+        lazy=False, options=None, variants=None):
+        """
+        Create several crops at once. The source image is read from storage and
+        decoded only once, all crops are rendered off the same in-memory image
+        and the model instance is saved a single time at the end::
+
+            >>> image.crops.create_many({
+            ...     'thumbnail': ((0, 0, 100, 150), (50, 75)),
+            ...     'banner': ((0, 200, 600, 100), None),
+            ... })
+
+        :param crops: Dictionary mapping crop names to 2-tuples of 
+            ``(spec, resize)``, see :attr:`create`.
+        :param save: Boolean, if specified the model is saved back to DB after 
+            all crops were created.
+        :param defer: Boolean, see :attr:`create`.
+        :param force: Boolean, see :attr:`create`.
+        :param lazy: Boolean, see :attr:`create`.
+        :param options: Dictionary of encoding options, see :attr:`create`.
+        :param variants: List of widths, see :attr:`create`.
+        :returns: Dictionary mapping the (validated) crop names to the created 
+            :attr:`CropFieldFile` objects.
+        """
+        crops = dict((self.validate_name(name), value) 
+            for name, value in crops.iteritems())
+
+        options = dict(self.field.options, **(options or {}))
+        source = self.get_source_identity()
+        specs = {}
+        replaced = set()
+
+        for name, (spec, resize) in crops.iteritems():
+            (x, y, width, height) = spec
+            spec = dict(x=x, y=y, width=width, height=height)
+
+            if resize is not None:
+                spec['resize'] = list(resize)
 
-        (x, y, width, height) = spec
-        spec = {name: dict(x=x, y=y, width=width, height=height)}
+            if options:
+                spec['options'] = options
+
+            self.set_filenames(name, spec, source, variants)
+            spec['source'] = source
+            spec['fingerprint'] = self.get_fingerprint(spec, source)
+
+            if not force and self.is_current(name, spec['fingerprint']):
+                continue
+
+            # Files of an existing crop are deleted once it was replaced
+            if name in self.data:
+                getattr(self, name).release()
+                replaced.update(get_filenames(self.data[name]))
+
+            specs[name] = spec
+
+        started = time.time()
+
+        if defer or lazy:
+            for spec in specs.values():
+                spec['pending'] = True
+        else:
+            timer = self.render(specs)
+
+        self.data = dict(self.data, **specs)
         
-        processors = [Crop(**spec[name])]
+        if save and specs:
+            self.save_instance()
+
+        self.delete_replaced(replaced, specs)
+
+        if defer and specs:
+            if self._batch:
+                self._queued.extend(specs.keys())
+            else:
+                queues.enqueue(self, specs.keys())
+        elif specs and not lazy:
+            timer.add('total', time.time() - started)
+            self.send_signal(signals.crop_created, 'created', specs.keys(), timer)
+
+        return dict((name, getattr(self, name)) for name in crops)
+
+    def regenerate(self, names=None, save=True):
+        """
+        Render crops again from their stored specs, e.g. after changing encoder
+        settings or to render pending crops created with ``defer=True``. 
+        The source image is decoded once for all crops. Crops are rendered to
+        new files and the old ones are only deleted once the new ones were 
+        written, so a failed render leaves the crops as they were.
+
+        The field's current encoding options, see :attr:`CropField`, are 
+        merged into the options stored with each crop, so changed options 
+        take effect. Options given to :attr:`create` for other keys are kept.
+
+        :param names: List of crop names. Defaults to all crops.
+        :param save: Boolean, if specified the model is saved back to DB after
+            all crops were rendered.
+        """
+        if names is None:
+            names = self.data.keys()
+
+        source = self.get_source_identity()
+        specs = {}
+        replaced = set()
+
+        for name in names:
+            name = self.validate_name(name)
+            spec = dict(self.data[name])
+            spec.pop('pending', None)
+            spec['variants'] = [dict(variant) for variant in spec.get('variants', [])]
+
+            options = dict(spec.pop('options', None) or {}, **self.field.options)
+            if options:
+                spec['options'] = options
+
+            # Crops are written next to their current files, storage picks a
+            # free name if needed. Content addressed files are shared and 
+            # never change, they are only rendered again if missing.
+            replaced.update(get_filenames(self.data[name]))
+            self.set_filenames(name, spec, source, 
+                [variant['width'] for variant in spec['variants']])
+
+            if not spec['variants']:
+                del spec['variants']
+
+            spec['source'] = source
+            spec['fingerprint'] = self.get_fingerprint(spec, source)
+
+            specs[name] = spec
+
+        started = time.time()
+        timer = self.render(specs)
+
+        self.data = dict(self.data, **specs)
+
+        if save:
+            self.save_instance()
+
+        self.delete_replaced(replaced, specs)
+
+        timer.add('total', time.time() - started)
+        self.send_signal(signals.crop_created, 'created', specs.keys(), timer)
+
+    def delete_replaced(self, filenames, specs):
+        """
+        Delete the files of replaced crops, those of ``filenames`` the new 
+        ``specs`` don't use. Content addressed files are only deleted if no 
+        other crop refers to them, see :attr:`get_unreferenced`.
+        """
+        filenames = set(filenames)
+
+        for spec in specs.values():
+            filenames.difference_update(get_filenames(spec))
+
+        if self.field.content_addressed:
+            filenames = self.get_unreferenced(list(filenames))
+
+        for filename in filenames:
+            self.field.storage.delete(filename)
+
+    def get_stale(self):
+        """
+        Return the names of crops rendered from a different source image than
+        the current one, comparing the ``source`` identity recorded in their
+        specs, see :attr:`get_source_identity`. Crops created before sources
+        were recorded are never considered stale.
+        """
+        specs = dict((name, spec) for name, spec in self.data.iteritems()
+            if spec.get('source') is not None)
+
+        if not specs or not self.image:
+            return []
+
+        source = self.get_source_identity()
+        return [name for name, spec in specs.iteritems() 
+            if list(spec['source']) != source]
+
+    def invalidate(self, defer=False, save=True):
+        """
+        Render stale crops, see :attr:`get_stale`, again. Called after the 
+        model instance was saved with a changed source image if the field's
+        ``invalidate`` argument is set, see :attr:`CropField`.
+
+        :param defer: Boolean, if specified the crops are marked pending and
+            handed to the :mod:`croppy.queues` backend like crops created with
+            ``defer=True``.
+        :param save: Boolean, if specified the model is saved back to DB.
+        :returns: List of the stale crop names.
+        """
+        names = self.get_stale()
+
+        if not names:
+            return names
+
+        if not defer:
+            self.regenerate(names, save)
+            return names
+
+        self.data = dict((name, dict(self.data[name], pending=True)) 
+            for name in names)
+
+        if save:
+            self.save_instance()
+
+        if self._batch:
+            self._queued.extend(names)
+        else:
+            queues.enqueue(self, names)
+
+        return names
+
+    def render(self, specs):
+        """
+        Render the crops described by ``specs``, a dictionary mapping crop 
+        names to specs, and update the specs with the metadata described in 
+        :attr:`generate`.
+
+        Decoding and rendering is admitted against the :mod:`croppy.budget`, 
+        which may block or raise 
+        :attr:`croppy.budget.MemoryBudgetExceeded`.
+
+        Returns a :attr:`croppy.stats.Timer` with the time spent in each stage.
+        """
+        timer = stats.Timer()
+
+        if self.field.content_addressed:
+            specs = dict((name, spec) for name, spec in specs.iteritems()
+                if not self.reuse_files(spec))
+
+        if not specs:
+            return timer
+
+        with budget.admit(lambda: self.get_footprint(specs), timer):
+            with self.open_source(specs, timer) as (img, scale, offset):
+                names = specs.keys()
+                jobs = [(self.get_processors(specs[name], scale, offset), 
+                    specs[name]['filename'], specs[name].get('options')) 
+                    for name in names]
+
+                for name, generated in zip(names, self.generate_many(img, jobs, timer)):
+                    specs[name].update(generated)
+
+                workers.map(lambda spec: self.generate_variants(img, scale, spec, 
+                        timer, offset),
+                    [spec for spec in specs.values() if spec.get('variants')],
+                    self.field.workers, 'thread')
+
+        return timer
+
+    def reuse_files(self, spec):
+        """
+        If all files of a content addressed crop spec exist in storage already,
+        fill in the spec's metadata without rendering and return ``True``.
+        """
+        storage = self.field.storage
+
+        if not all(storage.exists(filename) for filename in get_filenames(spec)):
+            return False
+
+        width, height = spec.get('resize') or (spec['width'], spec['height'])
+
+        spec.update(
+            output_width=width,
+            output_height=height,
+            size=storage.size(spec['filename']),
+            format=self.get_format(None, spec['filename'], spec.get('options')))
+
+        for variant in spec.get('variants', []):
+            variant.update(
+                height=int(round(spec['height'] * float(variant['width']) / spec['width'])),
+                size=storage.size(variant['filename']))
+
+        return True
+
+    def generate_variants(self, img, scale, spec, timer=None, offset=(0, 0)):
+        """
+        Render the width variants of a crop spec off the decoded source image
+        ``img`` and update them with their height, byte size and the name they
+        were saved under. ``scale`` and ``offset`` are described in 
+        :attr:`get_processors`.
+        """
+        timer = timer or stats.Timer()
+        processors = self.get_processors(dict(spec, resize=None), scale, offset)
+        variants = spec['variants']
+        format = self.get_format(img, variants[0]['filename'], spec.get('options'))
+
+        rendered = render_variants((self.field.get_engine(), img, processors, 
+            [variant['width'] for variant in variants], format, spec.get('options')))
+
+        for variant, (data, size, timings) in zip(variants, rendered):
+            timer.update(timings)
+            generated = self.save_file(variant['filename'], data, size, format, timer)
+            variant.update(filename=generated['filename'], height=size[1], 
+                size=len(data))
+
+    def send_signal(self, signal, event, names, timer):
+        """
+        Send one of the :mod:`croppy.signals` and report the timer to the 
+        :mod:`croppy.stats` sink.
+        """
+        stats.report(event, timer)
+        signal.send(sender=type(self.instance), instance=self.instance, 
+            field=self.field, names=list(names), timings=timer.timings, 
+            counters=timer.counters)
+
+    def is_current(self, name, fingerprint):
+        """
+        Return whether the named crop was rendered from the given fingerprint
+        and its file is in storage, so it doesn't need to be rendered again. 
+        Pending crops are never current.
+        """
+        spec = self.data.get(name)
+
+        if spec is None or spec.get('fingerprint') != fingerprint:
+            return False
+
+        crop = getattr(self, name)
+        return not crop.pending and self.field.storage.exists(crop.name)
+
+    def get_source_identity(self):
+        """
+        Identify the current source image by its name, byte size and, if the
+        storage backend supports it, modification time.
+        """
+        name, storage = self.image.name, self.image.storage
+        identity = [name, storage.size(name)]
+
+        modified_time = getattr(storage, 'get_modified_time', None) or \
+            storage.modified_time
+        try:
+            identity.append(modified_time(name).isoformat())
+        except NotImplementedError:
+            pass
+
+        return identity
+
+    def get_fingerprint(self, spec, source):
+        """
+        Hash everything that determines a crop's output: the spec's coordinates,
+        resize, filename, encoding options and variant widths, the processors 
+        rendering it and the ``source`` identity as returned by 
+        :attr:`get_source_identity`.
+        """
+        inputs = dict((key, spec.get(key)) for key in ('filename', 'options'))
+        inputs['variants'] = [variant['width'] for variant in spec.get('variants', [])]
+        return self.get_digest(spec, source, inputs)
+
+    def get_digest(self, spec, source, inputs=None):
+        """
+        Hash a crop spec's coordinates and resize, the processors rendering it,
+        the ``source`` identity and any additional ``inputs``.
+        """
+        inputs = dict(inputs or {}, **dict((key, spec.get(key)) 
+            for key in ('x', 'y', 'width', 'height', 'resize')))
+        processors = [('%s.%s' % (type(p).__module__, type(p).__name__), vars(p))
+            for p in self.get_processors(spec)]
+
+        return hashlib.md5(json.dumps([inputs, processors, source], 
+            sort_keys=True, default=repr)).hexdigest()
+
+    def set_filenames(self, name, spec, source, widths=None):
+        """
+        Set the filenames of a crop spec and of its variants of the given 
+        ``widths``. Unless the field is content addressed, names are built by
+        :attr:`get_filename`, with the crop's version if the field is 
+        versioned, see :attr:`CropField`.
+        """
+        format = (spec.get('options') or {}).get('format')
+        spec.pop('version', None)
+
+        if self.field.content_addressed:
+            spec['filename'] = self.get_content_filename(name, spec, source, format)
+        else:
+            if self.field.versioned:
+                spec['version'] = self.get_version(spec, source, widths)
+            spec['filename'] = self.get_filename(name, format, spec.get('version'))
+
+        if not widths:
+            return
+
+        spec['variants'] = []
+
+        for width in sorted(set(widths), reverse=True):
+            if self.field.content_addressed:
+                filename = self.get_content_filename(name, spec, source, format, 
+                    width)
+            else:
+                filename = self.get_filename('%s_%dw' % (name, width), format, 
+                    spec.get('version'))
+
+            spec['variants'].append(dict(width=width, filename=filename))
+
+    def get_version(self, spec, source, widths=None):
+        """
+        Return a short digest of a crop spec, its encoding options and variant
+        ``widths`` and the ``source`` identity, to be embedded in the 
+        filenames of versioned crops.
+        """
+        return self.get_digest(spec, source, dict(options=spec.get('options'), 
+            variants=sorted(set(widths or []))))[:VERSION_LENGTH]
+
+    def get_content_filename(self, name, spec, source, format=None, width=None):
+        """
+        Return a filename derived from a hash of the ``source`` identity, the 
+        crop spec and its encoding options, as used by :attr:`CropField` with 
+        ``content_addressed=True``. Identical crops of the same source image 
+        share one file. The directory and extension are taken from
+        :attr:`get_filename`.
+
+        :param width: Width of a variant to get the filename for.
+        """
+        digest = self.get_digest(spec, source, 
+            dict(options=spec.get('options'), variant=width))
+        directory, filename = os.path.split(self.get_filename(name, format))
+        return os.path.join(directory, digest + os.path.splitext(filename)[1])
+
+    def get_processors(self, spec, scale=(1, 1), offset=(0, 0)):
+        """
+        Return the list of processors rendering the given crop spec. Resized
+        crops are rendered by the fused :attr:`CropResize` processor.
         
-        if resize is not None:
-            processors.append(Resize(resize[0], resize[1]))
+        :param scale: 2-tuple of the factors the source image was reduced by 
+            when decoding it, see :attr:`open_image`. The crop coordinates are
+            scaled down accordingly.
+        :param offset: 2-tuple of the position of the decoded region in the
+            source image, see :attr:`open_source`. The crop coordinates are
+            shifted accordingly.
+        """
+        (sx, sy), (ox, oy) = scale, offset
+        x0, y0 = int(round(spec['x'] / sx)) - ox, int(round(spec['y'] / sy)) - oy
+        x1 = int(round((spec['x'] + spec['width']) / sx)) - ox
+        y1 = int(round((spec['y'] + spec['height']) / sy)) - oy
+
+        if spec.get('resize') is not None:
+            return [CropResize(x0, y0, x1 - x0, y1 - y0, spec['resize'])]
+
+        return [Crop(x0, y0, x1 - x0, y1 - y0)]
+
+    def get_max_reduction(self, specs):
+        """
+        Return the largest factor the source image can be reduced by such that
+        every crop in ``specs`` still has at least as many pixels as its 
+        requested output size and variants. Crops that are not resized always
+        need the full resolution.
+        """
+        reduction = float('inf')
+
+        for spec in specs.values():
+            if spec.get('resize') is None:
+                return 1
+
+            width, height = spec['resize']
+            reduction = min(reduction, 
+                float(spec['width']) / width, float(spec['height']) / height)
+
+            for variant in spec.get('variants', []):
+                reduction = min(reduction, float(spec['width']) / variant['width'])
+
+        return reduction
+
+    def get_reduction(self, specs):
+        """
+        Return the largest power-of-two factor (up to 8) the source image can be
+        reduced by while decoding, see :attr:`get_max_reduction`.
+        """
+        reduction, factor = 8, self.get_max_reduction(specs)
+
+        while reduction > 1 and reduction > factor:
+            reduction //= 2
+
+        return reduction
+
+    @property
+    def pyramid(self):
+        """
+        The levels of the source pyramid built for :attr:`CropField` with the
+        ``pyramid`` argument, a list of dictionaries with the level's 
+        reduction ``factor``, its ``filename``, ``width`` and ``height``, the 
+        ``scale`` it was actually reduced by in both directions and the 
+        ``source`` identity it was built from. Stored with the crop data.
+        """
+        self.data
+        return self._pyramid
+
+    def get_level(self, specs, timer=None):
+        """
+        Return the :attr:`pyramid` level with the largest factor that still
+        covers every crop in ``specs``, see :attr:`get_max_reduction`, or 
+        ``None`` if no level does. The pyramid is (re)built first if the 
+        source image changed since it was built.
+        """
+        if not self.uses_pyramid(specs):
+            return None
+
+        if not self.is_pyramid_current():
+            self.build_pyramid(timer)
+
+        reduction = self.get_max_reduction(specs)
+        levels = [level for level in self.pyramid if level['factor'] <= reduction]
+        return max(levels, key=lambda level: level['factor'])
+
+    def uses_pyramid(self, specs):
+        """
+        Return whether the crops in ``specs`` are rendered from a 
+        :attr:`pyramid` level, see :attr:`get_level`.
+        """
+        return bool(self.field.pyramid) and \
+            self.get_max_reduction(specs) >= min(self.field.pyramid)
+
+    def is_pyramid_current(self):
+        """
+        Return whether the :attr:`pyramid` has the field's levels and was built
+        from the current source image.
+        """
+        source = self.get_source_identity()
+        return sorted(level['factor'] for level in self.pyramid) == \
+            sorted(set(self.field.pyramid)) and \
+            all(level['source'] == source for level in self.pyramid)
+
+    def build_pyramid(self, timer=None):
+        """
+        Decode the source image, render each of the field's pyramid levels by
+        successively downscaling it and write them to :attr:`field.storage` in
+        the source's format. Replaces any previous levels. The model instance
+        is not saved.
+        """
+        timer = timer or stats.Timer()
+        self.delete_pyramid()
+
+        engine = self.field.get_engine()
+        img, _ = self.open_image(1, timer)
+        width, height = engine.get_size(img)
+        format = self.get_format(img, self.image.name)
+        source = self.get_source_identity()
+        level = img
+
+        for factor in sorted(set(self.field.pyramid)):
+            size = (max(1, width // factor), max(1, height // factor))
+
+            with timer('pyramid'):
+                level = engine.resize(level, size)
+                # Levels are sources themselves, keep them close to lossless
+                data = engine.encode(level, format, 
+                    {'quality': 95, 'strip_metadata': False}, img)
+
+            # Crop names can't contain hyphens, so this never clashes
+            generated = self.save_file(self.get_filename('pyramid-%d' % factor),
+                data, size, format, timer)
+
+            self._pyramid.append(dict(factor=factor, 
+                filename=generated['filename'], width=size[0], height=size[1], 
+                scale=[float(width) / size[0], float(height) / size[1]],
+                source=source))
+
+        return self._pyramid
+
+    def delete_pyramid(self):
+        """
+        Delete the files of all :attr:`pyramid` levels. The model instance is
+        not saved.
+        """
+        for level in self.pyramid:
+            self.field.storage.delete(level['filename'])
+
+        self._pyramid = []
+
+    def get_footprint(self, specs):
+        """
+        Estimate the memory needed to decode the image ``specs`` are rendered 
+        from, see :attr:`open_source`, assuming four bytes per pixel. That is
+        the :attr:`pyramid` level if one is used, the whole source image if 
+        the pyramid has to be built first, or the part of the source the 
+        field's engine decodes, see 
+        :attr:`croppy.engines.BaseEngine.get_decoded_size`.
         
-        filename = self.get_filename(name)
+        With a process pool, the copy of the image sent to the workers and one
+        copy per worker process are added.
+        """
+        engine = self.field.get_engine()
+        size = (self.image.width, self.image.height)
+
+        if self.uses_pyramid(specs):
+            # A stale pyramid is rebuilt from the whole source image first
+            if self.is_pyramid_current():
+                level = self.get_level(specs)
+                size = (level['width'], level['height'])
+        else:
+            size = engine.get_decoded_size(
+                lambda: self.image.storage.open(self.image.name), size,
+                engines.get_format(self.image.name), self.get_reduction(specs),
+                self.get_region(specs))
+
+        footprint = size[0] * size[1] * 4
+        count = min(workers.get_workers(self.field.workers), len(specs))
+
+        if engine.picklable and count > 1 and \
+                workers.get_kind(self.field.pool) == 'process':
+            footprint *= 2 + count
+
+        return footprint
+
+    def get_region(self, specs):
+        """
+        Return the ``(x0, y0, x1, y1)`` bounding box of all crops in ``specs``
+        in source image coordinates.
+        """
+        specs = specs.values()
+        return (min(spec['x'] for spec in specs), 
+            min(spec['y'] for spec in specs),
+            max(spec['x'] + spec['width'] for spec in specs),
+            max(spec['y'] + spec['height'] for spec in specs))
+
+    @contextmanager
+    def open_source(self, specs, timer=None):
+        """
+        Open the image to render the crops in ``specs`` from with the field's
+        engine, see :mod:`croppy.engines`, for the duration of the ``with`` 
+        block. That is the :attr:`pyramid` level returned by 
+        :attr:`get_level` or the source image, which engines may reduce by
+        :attr:`get_reduction` or decode only in the :attr:`get_region` of the
+        crops while decoding. The file is kept open as engines may decode on 
+        demand.
+
+        Yields a 3-tuple of the image, the ``(x, y)`` factors it was reduced
+        by and the ``(x, y)`` offset of the decoded part in the source image,
+        see :attr:`get_processors`.
+        """
+        timer = timer or stats.Timer()
+        level = self.get_level(specs, timer)
+
+        if level is not None:
+            storage, name = self.field.storage, level['filename']
+            reduction, box = 1, None
+        else:
+            storage, name = self.image.storage, self.image.name
+            reduction, box = self.get_reduction(specs), self.get_region(specs)
+
+        files = [storage.open(name)]
+
+        def reopen():
+            files.append(storage.open(name))
+            return files[-1]
+
+        try:
+            img, scale, offset = self.field.get_engine().open(files[0], 
+                reduction, box, timer, reopen=reopen)
+
+            if level is not None:
+                scale = tuple(level['scale'])
+
+            yield img, scale, offset
+        finally:
+            for fp in files:
+                fp.close()
+
+    def open_image(self, reduction=1, timer=None):
+        """
+        Read the whole source image from storage and decode it with the 
+        field's engine. The returned image can be passed to :attr:`generate`
+        and :attr:`generate_many` any number of times.
+
+        JPEG sources are decoded at a reduced size if ``reduction`` is larger
+        than 1, which is a lot faster and needs less memory than decoding at 
+        full resolution. Other formats are always decoded at full resolution.
+
+        Returns a 2-tuple of the image and the ``(x, y)`` factors it was
+        reduced by.
+        """
+        engine = self.field.get_engine()
+        fp = self.image.storage.open(self.image.name)
+
+        try:
+            img, scale, _ = engine.open(fp, reduction, None, timer)
+            return engine.load(img), scale
+        finally:
+            fp.close()
 
-        spec[name]['filename'] = filename
+    def generate(self, img, processors, filename, options=None, timer=None):
+        """
+        Run ``processors`` on the decoded source image ``img``, encode the 
+        result with the given encoding ``options`` and write it to 
+        :attr:`field.storage`. Unless the options specify a format, follows 
+        :attr:`imagekit.generators.SpecFileGenerator` in guessing the output 
+        format from the filename's extension. 
 
-        # If a crop exists already, delete it first
-        if hasattr(self, name):
-            self.delete(name, save=False)
+        Returns a dictionary with the name the crop was saved under and its 
+        output dimensions, byte size and format, to be stored in the crop's 
+        spec::
 
-        generator = SpecFileGenerator(processors, storage=self.field.storage)
-        generator.generate_file(filename, self.image)
+            {'filename': 'crops/test-rect.tiff', 'output_width': 100, 
+             'output_height': 50, 'size': 15212, 'format': 'TIFF'}
+        """
+        timer = timer or stats.Timer()
+        format = self.get_format(img, filename, options)
+        data, size, timings = render((self.field.get_engine(), img, processors, 
+            format, options))
+        timer.update(timings)
+        return self.save_file(filename, data, size, format, timer)
 
-        self.data = dict(self.data, **spec)
+    def generate_many(self, img, jobs, timer=None):
+        """
+        Like :attr:`generate`, but renders a list of ``(processors, filename, 
+        options)`` jobs concurrently using the field's :attr:`croppy.workers` pool. With a
+        thread pool, encoding and writing to storage both happen in the 
+        workers. With a process pool, crops are encoded in the workers and 
+        written to storage from threads of this process.
+
+        Returns a list of dictionaries as described in :attr:`generate`, in 
+        the order of ``jobs``.
+        """
+        timer = timer or stats.Timer()
+        engine = self.field.get_engine()
+
+        if workers.get_kind(self.field.pool) == 'thread' or not engine.picklable:
+            return workers.map(lambda job: self.generate(img, *job, timer=timer), 
+                jobs, self.field.workers, 'thread')
+
+        formats = [self.get_format(img, filename, options) 
+            for _, filename, options in jobs]
+        copy = engine.copy(img)
+        rendered = workers.map(render, 
+            [(engine, copy, processors, format, options) 
+                for (processors, _, options), format in zip(jobs, formats)],
+            self.field.workers, 'process')
+
+        for _, _, timings in rendered:
+            timer.update(timings)
+
+        return workers.map(lambda args: self.save_file(*args, timer=timer),
+            [(filename, data, size, format) for (_, filename, _), (data, size, _), format
+                in zip(jobs, rendered, formats)],
+            self.field.workers, 'thread')
+
+    def get_format(self, img, filename, options=None):
+        """
+        Return the format given in the encoding options or guess it from the 
+        filename's extension, falling back to the source image's format.
+        """
+        if options and options.get('format'):
+            return options['format'].upper()
+
+        format = engines.get_format(filename)
+
+        if format is None and img is not None:
+            format = self.field.get_engine().get_format(img)
+
+        return format or 'JPEG'
+
+    def save_file(self, filename, data, size, format, timer=None):
+        """
+        Write the encoded crop to :attr:`field.storage` and return its metadata
+        as described in :attr:`generate`. 
         
-        if save:
-            self.instance.save()
+        Content addressed and versioned names are unique to their content, so
+        they can't collide with a different file and are written without 
+        probing storage for an available name. That is done with the 
+        storage's ``_save()``, which every Django storage backend implements
+        for ``save()`` to call.
+        """
+        timer = timer or stats.Timer()
+        storage = self.field.storage
+        content = IKContentFile(filename, data, format=format)
+
+        with timer('write'):
+            if self.field.content_addressed or self.field.versioned:
+                filename = storage._save(filename, content)
+            else:
+                filename = storage.save(filename, content)
 
-        return getattr(self, name)
+        timer.incr('bytes_written', len(data))
+
+        return dict(
+            filename=filename,
+            output_width=size[0],
+            output_height=size[1],
+            size=len(data),
+            format=format)
 
         
     def delete(self, name, save=True):
@@ -140,24 +1218,96 @@ class CropFieldDescriptor(object):
         :param save: Boolean, whether to save the model instance or not after 
             deleting the file.
         """
-        name = self.validate_name(name)
-        crop = getattr(self, name)
-        delattr(self, name)
-        del self._data[name]
-        crop.delete(save)
+        self.delete_many([name], save)
+
+    def delete_many(self, names, save=True):
+        """
+        Delete the named crops. Files are deleted concurrently using the 
+        field's :attr:`croppy.workers` pool, or with a single call if the 
+        storage backend provides a ``delete_many(names)`` method. The model
+        instance is saved once at the end if save is specified.
+
+        Content addressed files (see :attr:`CropField`) are only deleted if 
+        no other crop refers to them, see :attr:`get_unreferenced`.
+
+        :param names: List of crop names
+        :param save: Boolean, whether to save the model instance or not after 
+            deleting the files.
+        """
+        crops, timer = [], stats.Timer()
+        started = time.time()
+
+        for name in names:
+            name = self.validate_name(name)
+            crops.append(getattr(self, name))
+            self.__dict__.pop(name, None)
+            del self.data[name]
+
+        storage = self.field.storage
+        filenames = sum([crop.filenames for crop in crops], [])
+
+        if self.field.content_addressed:
+            filenames = self.get_unreferenced(filenames)
+
+        with timer('delete'):
+            for crop in crops:
+                crop.release()
+
+            if hasattr(storage, 'delete_many'):
+                storage.delete_many(filenames)
+            else:
+                workers.map(storage.delete, filenames, self.field.workers, 'thread')
+
+        if save:
+            self.save_instance()
+
+        if crops:
+            timer.add('total', time.time() - started)
+            self.send_signal(signals.crop_deleted, 'deleted', 
+                [crop.crop_name for crop in crops], timer)
         
+    def get_unreferenced(self, filenames):
+        """
+        Return those of the given content addressed filenames no other crop of
+        this instance or of any other row of the model refers to. Other rows 
+        are checked with a single query matching any of the files' digests. 
+        References from other models or fields are not checked.
+
+        The check is not atomic with deleting the files: a crop of another row
+        created with the same digest in the meantime may reuse a file that is
+        deleted right after. Such crops are rendered again when created once 
+        more, see :attr:`create`.
+        """
+        referenced = set(sum([get_filenames(spec) for spec in self.data.values()], []))
+        digests = dict((filename, os.path.splitext(os.path.basename(filename))[0])
+            for filename in filenames if filename not in referenced)
+
+        if not digests:
+            return []
+
+        query = Q()
+        for digest in set(digests.values()):
+            query |= Q(**{'%s__contains' % self.field.name: digest})
+
+        rows = type(self.instance)._default_manager.filter(query)
+
+        if self.instance.pk is not None:
+            rows = rows.exclude(pk=self.instance.pk)
+
+        values = [value if isinstance(value, basestring) else json.dumps(value)
+            for value in rows.values_list(self.field.name, flat=True)]
+
+        return [filename for filename in filenames if filename in digests
+            and not any(digests[filename] in value for value in values)]
+
     def clear(self, save=True):
         """ 
-        Deletes all crops on this field.
+        Deletes all crops on this field, see :attr:`delete_many`.
         
         :param save: Boolean, whether to save the model instance or not after 
             deleting the file.
         """
-        for crop in self:
-            self.delete(crop.crop_name, save=False)
-        
-        if save:
-            self.instance.save()
+        self.delete_many(self.data.keys(), save)
         
     
     def validate_name(self, name):
@@ -168,18 +1318,42 @@ class CropFieldDescriptor(object):
         Raises :attr:`django.core.exceptions.ValidationError` in case there is 
         a clash.
         """
-           
-        if hasattr(self, name) and not isinstance(getattr(self, name), CropFieldFile):
+        if name in self.__dict__:
+            clash = not isinstance(self.__dict__[name], CropFieldFile)
+        else:
+            clash = hasattr(type(self), name)
+
+        if clash:
             raise ValidationError(
                 "Cannot override existing attribute '%s' with crop file." % name
             )
-        return slugify(name).replace('-', '_')
+
+        name = slugify(name).replace('-', '_')
+
+        if name in (PYRAMID_KEY, COMPACT_VERSION_KEY):
+            raise ValidationError("Crop name '%s' is reserved." % name)
+
+        return name
              
-    def get_filename(self, name):
+    def get_filename(self, name, format=None, version=None):
         """
-        Delegate filename creation to :attr:`field.upload_to`. 
+        Delegate filename creation to :attr:`field.upload_to`. If an output 
+        format is given, the image's filename is passed on with that format's
+        extension. A ``version`` is inserted before the resulting filename's
+        extension, e.g. ``crops/image-thumbnail.5d41402a.png``.
         """
-        return self.field.upload_to(self.instance, os.path.split(self.image.name)[-1], name)
+        filename = os.path.split(self.image.name)[-1]
+
+        if format:
+            filename = os.path.splitext(filename)[0] + engines.get_extension(format)
+
+        filename = self.field.upload_to(self.instance, filename, name)
+
+        if version:
+            filename = '%s.%s%s' % (os.path.splitext(filename)[0], version,
+                os.path.splitext(filename)[1])
+
+        return filename
     
     @property
     def data(self):
@@ -191,7 +1365,9 @@ class CropFieldDescriptor(object):
                 'thumbnail': {
                     'x': 0, 'y': 0, 
                     'width': 100, 'height': 100,
-                    'name': 'crops/image_thumbnail.png'
+                    'name': 'crops/image_thumbnail.png',
+                    'output_width': 50, 'output_height': 50,
+                    'size': 2048, 'format': 'PNG'
                 }, 
                 'skyscraper': {
                     'x': 0, 'y': 0,
@@ -201,28 +1377,150 @@ class CropFieldDescriptor(object):
             }
         
         """
+        if self._data is None:
+            raw, self._raw = self._raw, None
+            self._data = {}
+            value = dict(self.unpack(self.field.to_python(raw) or {}))
+            self._pyramid = value.pop(PYRAMID_KEY, [])
+            self.data = value
         return self._data
     
     @data.setter
     def data(self, value):
         """ 
-        Sets the data attribute and generates :attr:`CropFieldFiles`
-        for convenience methods and attributes like :attr:`CropFieldFiles.delete`,
-        :attr:`CropFieldFiles.url`, :attr:`CropFieldFiles.path`, etc.
+        Sets the data attribute. :attr:`CropFieldFiles` for convenience methods
+        and attributes like :attr:`CropFieldFiles.delete`, :attr:`CropFieldFiles.url`,
+        :attr:`CropFieldFiles.path`, etc. are generated on first access.
         """
+        data = self.data
+
         for name, spec in value.iteritems():
             name = self.validate_name(name)
-            self._data[name] = spec
+            data[name] = spec
 
-            if hasattr(self, name):
-                continue
+            # Drop any crop file built from a previous spec
+            self.__dict__.pop(name, None)
 
-            setattr(self, name, CropFieldFile(
-                name, spec,
-                self.instance,
-                self.field,
-                spec['filename']))
+    def __getattr__(self, name):
+        """
+        Only called when ``name`` is not found through normal lookup. Creates
+        the :attr:`CropFieldFile` for the named crop and caches it on the 
+        descriptor.
+        """
+        if name.startswith('__') or '_raw' not in self.__dict__:
+            raise AttributeError(name)
+
+        spec = self.data.get(name)
+        if spec is None:
+            raise AttributeError(name)
+
+        crop = CropFieldFile(name, spec, self.instance, self.field, 
+            spec['filename'])
+        self.__dict__[name] = crop
+        return crop
     
+    def pack(self):
+        """
+        Return the crop data in the compact serialization used by
+        :attr:`CropField` with ``compact=True``::
+
+            {"_v": 1, "c": {"thumbnail": [0, 0, 100, 100, [50, 50], 50, 50, 
+                2048, "PNG", "5d41402abc4b2a76b9719d911017c592",
+                "crops/image-thumbnail.png"]}}
+
+        Specs are stored as arrays of the :attr:`COMPACT_KEYS` values, followed
+        by a dictionary of any other keys. Variants are stored as ``[width, 
+        height, size]`` arrays, with the filename appended only if it differs
+        from what :attr:`get_variant_filename` derives from the crop's stored
+        filename. Nothing is derived from the source image's name or 
+        ``upload_to``, which may have changed since.
+        """
+        crops = {}
+
+        for name, spec in self.data.iteritems():
+            spec = dict(spec)
+            filename = spec['filename']
+            values = [spec.pop(key, None) for key in COMPACT_KEYS]
+
+            if 'variants' in spec:
+                spec['variants'] = [self.pack_variant(filename, variant, 
+                    spec.get('version'))
+                    for variant in spec['variants']]
+
+            if spec:
+                values.append(spec)
+            else:
+                while values and values[-1] is None:
+                    values.pop()
+
+            crops[name] = values
+
+        if self.pyramid:
+            return {COMPACT_VERSION_KEY: COMPACT_VERSION, 'c': crops, 
+                PYRAMID_KEY: self.pyramid}
+
+        return {COMPACT_VERSION_KEY: COMPACT_VERSION, 'c': crops}
+
+    def pack_variant(self, filename, variant, version=None):
+        values = [variant['width'], variant.get('height'), variant.get('size')]
+
+        if variant['filename'] != get_variant_filename(filename, 
+                variant['width'], version):
+            values.append(variant['filename'])
+
+        return values
+
+    def unpack(self, value):
+        """
+        Turn deserialized crop data into a dictionary of specs. Reads both the
+        compact serialization described in :attr:`pack` and the plain 
+        dictionaries crops were stored as before, which may hold a crop named
+        like :attr:`COMPACT_VERSION_KEY` from before it was reserved.
+        """
+        version = value.get(COMPACT_VERSION_KEY)
+
+        if not isinstance(version, (int, long)) or 'c' not in value:
+            return value
+
+        if version != COMPACT_VERSION:
+            raise ValueError("Unknown crop data version %r." % version)
+
+        data = {}
+
+        for name, values in value['c'].iteritems():
+            spec = {}
+
+            if values and isinstance(values[-1], dict):
+                spec.update(values[-1])
+                values = values[:-1]
+
+            for key, item in zip(COMPACT_KEYS, values):
+                if item is not None:
+                    spec[key] = item
+
+            if 'variants' in spec:
+                spec['variants'] = [self.unpack_variant(spec['filename'], 
+                    variant, spec.get('version'))
+                    for variant in spec['variants']]
+
+            data[name] = spec
+
+        if PYRAMID_KEY in value:
+            data[PYRAMID_KEY] = value[PYRAMID_KEY]
+
+        return data
+
+    def unpack_variant(self, filename, values, version=None):
+        variant = dict(zip(('width', 'height', 'size'), values[:3]))
+
+        if len(values) > 3:
+            variant['filename'] = values[3]
+        else:
+            variant['filename'] = get_variant_filename(filename, 
+                variant['width'], version)
+
+        return variant
+
     def __iter__(self):
         for key in self.data.keys():
             yield getattr(self, key)
@@ -248,11 +1546,11 @@ class CropFieldCreator(object):
 
     def __set__(self, instance, data):
         """ 
-        Turn data from string into Python and store the CropFieldDescriptor
-        on the instance 
+        Store the CropFieldDescriptor on the instance. Turning the data from 
+        string into Python is deferred until the crops are accessed.
         """ 
         instance.__dict__[self.field.name] = CropFieldDescriptor(instance, self.field,
-            self.field.to_python(data))
+            data)
                                        
 
 
@@ -267,23 +1565,79 @@ class CropField(TextField):
     """
                                                
     def __init__(self, image_field=None, storage=DefaultStorage(),
-        upload_to=upload_to, editable=False, *args, **kwargs):
+        upload_to=upload_to, editable=False, workers=None, pool=None, 
+        options=None, compact=False, content_addressed=False, pyramid=None, 
+        versioned=False, invalidate=False, engine=None, *args, **kwargs):
         """
         Custom field to generate crops of custom sizes in custom locations.
         
         :param image_field: The name of the image field this cropper operates on.
-        :param storage: A custom storage backend to use.
+        :param storage: A custom storage backend to use. Its metadata is 
+            cached if configured, see :mod:`croppy.cache`.
         :param upload_to: A custom function to generate crop filenames. Must take
             three attributes, ``instance``, ``image`` and ``crop_name``. See
             :attr:`upload_to`.
+        :param workers: Number of workers rendering crops concurrently. Defaults
+            to the ``CROPPY_WORKERS`` setting. See :mod:`croppy.workers`.
+        :param pool: Either ``'thread'`` or ``'process'``. Defaults to the 
+            ``CROPPY_POOL`` setting.
+        :param options: Dictionary of encoding options for all crops, e.g. 
+            ``{'format': 'JPEG', 'quality': 80, 'progressive': True}``. 
+            Supported keys are ``format`` (PIL format name, defaults to the 
+            source's format), ``quality``, ``progressive`` and ``optimize`` 
+            (passed on to PIL) and ``strip_metadata`` (defaults to ``True``, 
+            set to ``False`` to keep the source's EXIF data and ICC profile).
+            Options are recorded in each crop's spec.
+        :param compact: If ``True``, crop data is written in a compact, 
+            versioned serialization, see :attr:`CropFieldDescriptor.pack`. 
+            Data in either serialization can always be read.
+        :param content_addressed: If ``True``, crop filenames are derived from
+            a hash of the source image's identity, the crop spec and encoding
+            options, see :attr:`CropFieldDescriptor.get_content_filename`. 
+            Identical crops, e.g. of instances sharing a source file, are 
+            rendered and stored once and their files never change, so they 
+            can be cached forever.
+        :param pyramid: List of factors, e.g. ``[4, 16]``, to keep copies of
+            the source image reduced by in :attr:`storage`. Resized crops are
+            rendered from the smallest copy that still covers their output 
+            size, see :attr:`CropFieldDescriptor.get_level`. The copies are 
+            built on first use, rebuilt when the source image changes and 
+            kept when crops are deleted, see 
+            :attr:`CropFieldDescriptor.delete_pyramid`.
+        :param versioned: If ``True``, a short digest of the crop spec, 
+            encoding options and source image is inserted into crop filenames,
+            see :attr:`CropFieldDescriptor.get_version`. Changing a crop or its
+            source image changes its filenames, so crop files never change and
+            can be served with far-future ``Cache-Control: immutable`` 
+            headers. Names are not probed for collisions with existing files,
+            see :attr:`CropFieldDescriptor.save_file`.
+        :param invalidate: When the model instance is saved with a different 
+            source image file, crops rendered from the previous file are 
+            rendered again, see :attr:`CropFieldDescriptor.invalidate`. 
+            ``True`` renders them right after saving, ``'defer'`` hands them 
+            to the :mod:`croppy.queues` backend and ``False`` (the default) 
+            leaves them alone, see :attr:`CropFieldDescriptor.get_stale`.
+        :param engine: Dotted path to the :mod:`croppy.engines` engine crops 
+            are rendered with, e.g. ``'croppy.engines.VipsEngine'``. Defaults
+            to the ``CROPPY_ENGINE`` setting.
         """
         assert image_field is not None, "You must specify an 'image_field' parameter."
 
         self.image_field = image_field
 
-        self.storage = storage
+        self.storage = cache.CachedStorage(storage)
         self.upload_to = upload_to 
 
+        self.workers = workers
+        self.pool = pool
+        self.options = options or {}
+        self.compact = compact
+        self.content_addressed = content_addressed
+        self.pyramid = pyramid
+        self.versioned = versioned
+        self.invalidate = invalidate
+        self.engine = engine
+
         kwargs['editable'] = editable
         
         self.json_field = jsonfield.JSONField(*args, **kwargs)
@@ -296,7 +1650,65 @@ class CropField(TextField):
         super(CropField, self).contribute_to_class(cls, name)
         setattr(cls, name, CropFieldCreator(self))
 
+        if not cls._meta.abstract:
+            model_signals.post_init.connect(self.remember_source, sender=cls)
+            model_signals.pre_save.connect(self.check_source, sender=cls)
+            model_signals.post_save.connect(self.invalidate_crops, sender=cls)
+
+    def get_source_name(self, instance):
+        """
+        Return the name of the instance's source image file without loading
+        deferred fields.
+        """
+        source = instance.__dict__.get(self.image_field)
+        return getattr(source, 'name', source)
+
+    def remember_source(self, instance, **kwargs):
+        crops = instance.__dict__.get(self.name)
+
+        if crops is not None:
+            crops._source_name = self.get_source_name(instance)
+
+    def check_source(self, instance, **kwargs):
+        """
+        Note whether the source image is being replaced, either with a new 
+        file that is written to storage as part of this save or by a file of
+        another name. Checking does not touch storage or load the crop data.
+        """
+        crops = instance.__dict__.get(self.name)
+
+        if crops is None or not self.invalidate or kwargs.get('raw'):
+            return
+
+        source = instance.__dict__.get(self.image_field)
+        crops._source_changed = not getattr(source, '_committed', True) or \
+            self.get_source_name(instance) != crops._source_name
+
+    def invalidate_crops(self, instance, **kwargs):
+        crops = instance.__dict__.get(self.name)
+
+        if crops is None or not crops._source_changed:
+            return
+
+        crops._source_changed = False
+        crops._source_name = self.get_source_name(instance)
+        crops.invalidate(defer=self.invalidate == 'defer')
+
+    def get_engine(self):
+        """
+        Return the :mod:`croppy.engines` engine crops are rendered with.
+        """
+        return engines.get_engine(self.engine)
+
     def get_db_prep_value(self, value, **kwargs):
+        if value._data is None and isinstance(value._raw, basestring):
+            # Crops were never accessed, write back what was loaded
+            return value._raw
+        if self.compact:
+            return json.dumps(value.pack(), separators=(',', ':'))
+        if value.pyramid:
+            return self.json_field.get_db_prep_value(
+                dict(value.data, **{PYRAMID_KEY: value.pyramid}), **kwargs)
         return self.json_field.get_db_prep_value(value.data, **kwargs)
 
     def to_python(self, value):
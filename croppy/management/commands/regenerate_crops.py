@@ -0,0 +1,133 @@
+from croppy import workers
+from croppy.tasks import get_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+import json
+import os
+import threading
+import time
+
+
+class Command(BaseCommand):
+    args = '<app_label.Model> <crop_field> [crop_name crop_name ...]'
+    help = ("Render crops again from their stored specs, with the field's "
+        "current encoding options. Rows are streamed in primary key order and "
+        "progress can be checkpointed to resume after a crash.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+            help='Number of rows loaded per query. Defaults to 500.'),
+        make_option('--workers', dest='workers', type='int', default=None,
+            help='Number of rows processed concurrently. Defaults to the '
+                'CROPPY_WORKERS setting.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='File to record progress in. If it exists, regeneration '
+                'resumes after the last completed chunk. It is removed once '
+                'all rows were processed.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) < 2:
+            raise CommandError("Usage: regenerate_crops %s" % self.args)
+
+        try:
+            app_label, model_name = args[0].split('.')
+        except ValueError:
+            raise CommandError("Model must be given as <app_label.Model>.")
+
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError("Unknown model '%s'." % args[0])
+
+        field_name, names = args[1], list(args[2:]) or None
+        chunk_size, checkpoint = options['chunk_size'], options['checkpoint']
+        verbosity = int(options.get('verbosity', 1))
+
+        progress = dict(last_pk=None, rows=0, crops=0, errors=0)
+
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                progress.update(json.load(f))
+            self.stdout.write("Resuming after primary key %r.\n" % progress['last_pk'])
+
+        main_thread = threading.current_thread()
+
+        def regenerate(instance):
+            try:
+                return self.regenerate(instance, field_name, names)
+            finally:
+                # Each pool thread has its own database connection, don't 
+                # leak them
+                if threading.current_thread() is not main_thread:
+                    connection.close()
+
+        started, rows, rendered = time.time(), 0, 0
+
+        while True:
+            queryset = model._default_manager.order_by('pk')
+
+            if progress['last_pk'] is not None:
+                queryset = queryset.filter(pk__gt=progress['last_pk'])
+
+            chunk = list(queryset[:chunk_size].iterator())
+
+            if not chunk:
+                break
+
+            # Crops of each row are rendered serially inside the pool threads
+            results = workers.map(regenerate, chunk, options['workers'], 'thread')
+
+            done = sum(result for result in results if result is not None)
+
+            rows += len(chunk)
+            rendered += done
+            progress['rows'] += len(chunk)
+            progress['crops'] += done
+            progress['errors'] += results.count(None)
+            progress['last_pk'] = chunk[-1].pk
+
+            if checkpoint:
+                self.write_checkpoint(checkpoint, progress)
+
+            if verbosity > 0:
+                elapsed = max(time.time() - started, 0.001)
+                self.stdout.write("%d rows, %d crops (%.1f rows/s, %.1f crops/s)\n" % (
+                    progress['rows'], progress['crops'], 
+                    rows / elapsed, rendered / elapsed))
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        elapsed = max(time.time() - started, 0.001)
+        self.stdout.write("Done: %d rows, %d crops, %d errors in %.1fs "
+            "(%.1f rows/s, %.1f crops/s).\n" % (progress['rows'], progress['crops'],
+            progress['errors'], elapsed, rows / elapsed, rendered / elapsed))
+
+    def regenerate(self, instance, field_name, names=None):
+        """
+        Render the named crops of an instance again. Returns the number of
+        crops rendered, ``None`` if rendering failed.
+        """
+        crops = getattr(instance, field_name)
+        crop_names = [name for name in (names or crops.data.keys())
+            if name in crops.data]
+
+        if not crop_names:
+            return 0
+        try:
+            crops.regenerate(crop_names)
+        except Exception as e:
+            self.stderr.write("Failed regenerating %s %r: %s\n" % (
+                type(instance).__name__, instance.pk, e))
+            return None
+        return len(crop_names)
+
+    def write_checkpoint(self, path, progress):
+        """
+        Write progress to a temporary file first, so a crash never leaves a 
+        truncated checkpoint behind.
+        """
+        with open(path + '.tmp', 'w') as f:
+            json.dump(progress, f)
+        os.rename(path + '.tmp', path)
@@ -0,0 +1,123 @@
+"""
+Queue backends rendering crops created with ``defer=True`` in the background.
+
+The backend is configured with the ``CROPPY_QUEUE`` setting, a dotted path to
+a :attr:`BaseQueue` subclass. It defaults to :attr:`ThreadQueue`, which 
+renders crops in a daemon thread of the current process. 
+
+Backends only need to implement :attr:`BaseQueue.enqueue`. The function and 
+arguments they are handed are picklable, so a Celery-like backend can be as
+simple as::
+
+    @task
+    def run(path, args):
+        module, name = path.rsplit('.', 1)
+        getattr(import_module(module), name)(*args)
+
+    class CeleryQueue(BaseQueue):
+        def enqueue(self, func, *args):
+            run.delay('%s.%s' % (func.__module__, func.__name__), args)
+"""
+from croppy.utils import import_by_path
+from django.conf import settings
+from django.db import connection, transaction
+import logging
+import threading
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+
+logger = logging.getLogger('croppy')
+
+
+class BaseQueue(object):
+    def enqueue(self, func, *args):
+        """
+        Arrange for ``func(*args)`` to be called in the background.
+        """
+        raise NotImplementedError
+
+class SyncQueue(BaseQueue):
+    """
+    Calls functions right away. Useful for tests and debugging.
+    """
+    def enqueue(self, func, *args):
+        func(*args)
+
+class ThreadQueue(BaseQueue):
+    """
+    Calls functions from daemon threads of the current process. The number of
+    threads is read from the ``CROPPY_QUEUE_THREADS`` setting and defaults to 
+    ``1``. Queued work is lost when the process exits.
+    """
+    def __init__(self):
+        self.queue = Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def enqueue(self, func, *args):
+        self.start()
+        self.queue.put((func, args))
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < getattr(settings, 'CROPPY_QUEUE_THREADS', 1):
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Failed rendering deferred crops.")
+            finally:
+                # Each thread has its own database connection, don't leak them
+                connection.close()
+                self.queue.task_done()
+
+
+_queues = {}
+_lock = threading.Lock()
+
+def get_queue():
+    """
+    Return the queue backend configured with ``CROPPY_QUEUE``.
+    """
+    path = getattr(settings, 'CROPPY_QUEUE', 'croppy.queues.ThreadQueue')
+
+    with _lock:
+        if path not in _queues:
+            _queues[path] = import_by_path(path)()
+        return _queues[path]
+
+def enqueue(descriptor, names):
+    """
+    Queue rendering the named crops of a :attr:`CropFieldDescriptor` once the
+    current transaction commits, so workers see the pending crops.
+
+    Django before 1.9 can't run code on commit and crops are queued right 
+    away. Workers may then find the instance missing or its crops not pending
+    yet and skip them, see :attr:`croppy.tasks.render_crops`. Such crops stay
+    pending until they are requested through :attr:`croppy.views.crop` or 
+    rendered with the ``regenerate_crops`` command.
+    """
+    from croppy.tasks import render_crops
+
+    instance = descriptor.instance
+
+    assert instance.pk is not None, "Cannot defer crops of unsaved instances."
+
+    args = (instance._meta.app_label, instance._meta.object_name, instance.pk,
+        descriptor.field.name, list(names))
+
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(lambda: get_queue().enqueue(render_crops, *args))
+    else:
+        get_queue().enqueue(render_crops, *args)
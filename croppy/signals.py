@@ -0,0 +1,15 @@
+from django.dispatch import Signal
+
+
+#: Sent after crops were rendered and written to storage, by 
+#: :attr:`CropFieldDescriptor.create` and :attr:`CropFieldDescriptor.regenerate`.
+#: ``timings`` maps stages (``read``, ``decode``, ``process``, ``encode``, 
+#: ``write`` and ``total``) to seconds, ``counters`` holds ``bytes_read`` and
+#: ``bytes_written``. See :mod:`croppy.stats`.
+crop_created = Signal(providing_args=['instance', 'field', 'names', 
+    'timings', 'counters'])
+
+#: Sent after crops were deleted by :attr:`CropFieldDescriptor.delete`,
+#: :attr:`CropFieldDescriptor.delete_many` and :attr:`CropFieldDescriptor.clear`.
+crop_deleted = Signal(providing_args=['instance', 'field', 'names', 
+    'timings', 'counters'])
@@ -0,0 +1,132 @@
+"""
+Per-stage timing of crop operations.
+
+Besides the :mod:`croppy.signals`, timings can be reported to a stats sink 
+configured with the ``CROPPY_STATS_SINK`` setting, a dotted path to a 
+:attr:`BaseSink` subclass. For example, with the ``statsd`` package::
+
+    class StatsdSink(BaseSink):
+        def __init__(self):
+            self.client = statsd.StatsClient()
+
+        def timing(self, name, seconds):
+            self.client.timing(name, seconds * 1000)
+
+        def incr(self, name, value=1):
+            self.client.incr(name, value)
+
+Metrics are named ``croppy.<event>.<stage>``, e.g. ``croppy.created.decode``
+or ``croppy.created.bytes_written``.
+"""
+from croppy.utils import import_by_path
+from django.conf import settings
+import threading
+import time
+
+
+class BaseSink(object):
+    def timing(self, name, seconds):
+        pass
+
+    def incr(self, name, value=1):
+        pass
+
+class Timer(object):
+    """
+    Collects the seconds spent in each stage and byte counters. Stages can be
+    timed from several threads at once, the time spent is summed up::
+
+        >>> timer = Timer()
+        >>> with timer('decode'):
+        ...     img.load()
+        >>> timer.timings
+        {'decode': 0.42}
+    """
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, stage):
+        return _Stage(self, stage)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.timings[stage] = self.timings.get(stage, 0) + seconds
+
+    def update(self, timings):
+        for stage, seconds in timings.iteritems():
+            self.add(stage, seconds)
+
+    def incr(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+class TimedFile(object):
+    """
+    Wraps a file object that is read from while decoding, recording the time
+    spent in its ``read`` calls as the timer's ``read`` stage and the bytes
+    read as its ``bytes_read`` counter. :attr:`seconds` is the time spent
+    reading so far, to be left out of the ``decode`` stage.
+    """
+    def __init__(self, fp, timer):
+        self.fp = fp
+        self.timer = timer
+        self.seconds = 0
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def read(self, *args):
+        started = time.time()
+        data = self.fp.read(*args)
+        seconds = time.time() - started
+
+        self.seconds += seconds
+        self.timer.add('read', seconds)
+        self.timer.incr('bytes_read', len(data))
+        return data
+
+class _Stage(object):
+    def __init__(self, timer, stage):
+        self.timer = timer
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.stage, time.time() - self.started)
+
+
+_sinks = {}
+_lock = threading.Lock()
+
+def get_sink():
+    """
+    Return the sink configured with ``CROPPY_STATS_SINK`` or ``None``.
+    """
+    path = getattr(settings, 'CROPPY_STATS_SINK', None)
+
+    if path is None:
+        return None
+
+    with _lock:
+        if path not in _sinks:
+            _sinks[path] = import_by_path(path)()
+        return _sinks[path]
+
+def report(event, timer):
+    """
+    Report a timer's timings and counters to the configured sink.
+    """
+    sink = get_sink()
+
+    if sink is None:
+        return
+
+    for stage, seconds in timer.timings.iteritems():
+        sink.timing('croppy.%s.%s' % (event, stage), seconds)
+
+    for counter, value in timer.counters.iteritems():
+        sink.incr('croppy.%s.%s' % (event, counter), value)
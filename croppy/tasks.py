@@ -0,0 +1,29 @@
+"""
+Functions run by :mod:`croppy.queues` backends. Arguments are plain values 
+so they can be pickled and sent to other processes.
+"""
+try:
+    from django.apps import apps
+    get_model = apps.get_model
+except ImportError:
+    from django.db.models import get_model
+
+
+def render_crops(app_label, model_name, pk, field_name, names):
+    """
+    Render pending crops of the given model instance. Crops that were deleted
+    or created again without deferring in the meantime are skipped.
+    """
+    model = get_model(app_label, model_name)
+
+    try:
+        instance = model._default_manager.get(pk=pk)
+    except model.DoesNotExist:
+        return
+
+    crops = getattr(instance, field_name)
+    names = [name for name in names 
+        if crops.data.get(name, {}).get('pending', False)]
+
+    if names:
+        crops.regenerate(names)
@@ -0,0 +1,13 @@
+try:
+    from django.conf.urls import url
+except ImportError:
+    from django.conf.urls.defaults import url
+
+from croppy import views
+
+
+urlpatterns = [
+    url(r'^(?P<app_label>\w+)/(?P<model_name>\w+)/(?P<pk>[^/]+)/'
+        r'(?P<field_name>\w+)/(?P<crop_name>\w+)/$', views.crop, 
+        name='croppy_crop'),
+]
@@ -0,0 +1,13 @@
+try:
+    from importlib import import_module
+except ImportError:
+    from django.utils.importlib import import_module
+
+
+def import_by_path(path):
+    """
+    Import and return the attribute given by a dotted path, e.g. 
+    ``'croppy.queues.ThreadQueue'``.
+    """
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)
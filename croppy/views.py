@@ -1 +1,118 @@
-# Create your views here.
+from croppy import cache
+from croppy.fields import CropField
+from croppy.tasks import get_model
+from django.db.models.fields import FieldDoesNotExist
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+import mimetypes
+import time
+
+
+#: Seconds versioned crops may be cached for.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+def crop(request, app_label, model_name, pk, field_name, crop_name):
+    """
+    Serve a crop, rendering it from its stored spec first if it is pending 
+    (see the ``lazy`` parameter of :attr:`CropFieldDescriptor.create`). 
+    Rendering holds a :attr:`croppy.cache.lock` on the instance's crops, so
+    concurrent requests render a crop once. Crops that were rendered are
+    never rendered again here, a missing file is a 404.
+    
+    File metadata is read through the field's storage, which is cached with
+    the ``CROPPY_CACHE`` setting, see :mod:`croppy.cache`.
+
+    Responses carry a strong ``ETag`` derived from the crop's fingerprint and
+    a ``Last-Modified`` header, and conditional requests are answered with
+    ``304 Not Modified``. Versioned crops requested with their current version
+    in the ``v`` query parameter, as :attr:`CropFieldFile.view_url` does, are 
+    marked as cacheable for a year and immutable.
+    """
+    model = get_model(app_label, model_name)
+    if model is None:
+        raise Http404
+
+    try:
+        field = model._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        raise Http404
+
+    if not isinstance(field, CropField):
+        raise Http404
+
+    crop = get_crop(model, pk, field_name, crop_name)
+
+    if crop.pending:
+        with cache.lock('%s.%s.%s.%s' % (app_label, model_name, pk, field_name)):
+            # Another request may have rendered it while we waited
+            crop = get_crop(model, pk, field_name, crop_name)
+
+            if crop.pending:
+                crops = getattr(crop.instance, field_name)
+                crops.regenerate([crop_name])
+                crop = getattr(crops, crop_name)
+
+    storage = field.storage
+
+    try:
+        mtime = time.mktime(storage.modified_time(crop.name).timetuple())
+    except (IOError, OSError):
+        raise Http404
+
+    etag = '"%s"' % crop.spec.get('fingerprint', crop.name)
+    immutable = crop.version is not None and request.GET.get('v') == crop.version
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+
+    if if_none_match is not None:
+        if etag in [tag.strip() for tag in if_none_match.split(',')] or \
+                if_none_match.strip() == '*':
+            return not_modified(etag, mtime, immutable)
+    elif not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), mtime):
+        return not_modified(etag, mtime, immutable)
+
+    try:
+        f = storage.open(crop.name)
+    except (IOError, OSError):
+        raise Http404
+
+    try:
+        content = f.read()
+    finally:
+        f.close()
+
+    content_type = mimetypes.guess_type(crop.name)[0] or 'application/octet-stream'
+
+    response = HttpResponse(content, content_type=content_type)
+    response['Content-Length'] = len(content)
+    set_validators(response, etag, mtime, immutable)
+    return response
+
+def get_crop(model, pk, field_name, crop_name):
+    """
+    Return the named :attr:`CropFieldFile` of the instance, read from the 
+    database.
+    """
+    instance = get_object_or_404(model._default_manager, pk=pk)
+    crops = getattr(instance, field_name)
+
+    if crop_name not in crops.data:
+        raise Http404
+
+    return getattr(crops, crop_name)
+
+def not_modified(etag, mtime, immutable=False):
+    response = HttpResponseNotModified()
+    set_validators(response, etag, mtime, immutable)
+    return response
+
+def set_validators(response, etag, mtime, immutable=False):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(mtime)
+
+    if immutable:
+        patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE,
+            immutable=True)
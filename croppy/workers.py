@@ -0,0 +1,90 @@
+"""
+Worker pools used to render crops concurrently.
+
+The pool size and kind are read from :attr:`CropField` or, if not specified
+there, from the ``CROPPY_WORKERS`` (default ``1``, meaning crops are rendered
+serially) and ``CROPPY_POOL`` (``'thread'`` or ``'process'``, default
+``'thread'``) settings.
+
+Pillow releases the GIL while decoding, resampling and encoding, so a thread
+pool is usually enough. Process pools require images to be picklable, which is
+the case for Pillow but not for the original PIL.
+
+:attr:`map` can also be used to fan out crop creation across many instances::
+
+    >>> from croppy import workers
+    >>> workers.map(lambda image: image.crops.create('square', (0, 0, 100, 100)),
+    ...     Image.objects.all(), workers=4)
+"""
+from django.conf import settings
+from multiprocessing.pool import Pool, ThreadPool
+import threading
+
+POOLS = {
+    'thread': ThreadPool,
+    'process': Pool,
+}
+
+_pools = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_workers(workers=None):
+    """
+    Return the number of workers to use, falling back to ``CROPPY_WORKERS``.
+    """
+    if workers is None:
+        workers = getattr(settings, 'CROPPY_WORKERS', 1)
+    return workers
+
+def get_kind(kind=None):
+    """
+    Return the kind of pool to use, falling back to ``CROPPY_POOL``.
+    """
+    kind = kind or getattr(settings, 'CROPPY_POOL', 'thread')
+    assert kind in POOLS, "Unknown pool kind '%s'." % kind
+    return kind
+
+def get_pool(workers=None, kind=None):
+    """
+    Return a process wide pool with ``workers`` workers of the given kind.
+    Pools are created on first use and shared afterwards. Returns ``None``
+    when work should be done serially, which is the case for a single worker
+    and for calls made from within a thread pool worker, as waiting on the
+    same pool from one of its own workers can deadlock.
+    """
+    workers, kind = get_workers(workers), get_kind(kind)
+
+    if workers <= 1 or getattr(_local, 'in_pool', False):
+        return None
+
+    with _lock:
+        if (kind, workers) not in _pools:
+            _pools[(kind, workers)] = POOLS[kind](workers)
+        return _pools[(kind, workers)]
+
+def map(func, iterable, workers=None, kind=None):
+    """
+    Apply ``func`` to every item of ``iterable`` using a pool from
+    :attr:`get_pool` and return the results as a list, in order. Functions
+    run in a process pool must be picklable, i.e. defined at module level.
+    """
+    pool = get_pool(workers, kind)
+
+    if pool is None:
+        return [func(item) for item in iterable]
+
+    if get_kind(kind) == 'thread':
+        func = _mark_in_pool(func)
+
+    return pool.map(func, iterable)
+
+def _mark_in_pool(func):
+    def wrapper(item):
+        _local.in_pool = True
+        try:
+            return func(item)
+        finally:
+            _local.in_pool = False
+    return wrapper
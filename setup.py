@@ -23,6 +23,7 @@ setup(
     url='https://github.com/caffeinehit/django-croppy',
     license=license,
     install_requires=install_requires,
+    extras_require={'vips': ['pyvips']},
     packages=find_packages(exclude=('tests*', 'docs*'))
 )
 
@@ -1,11 +1,20 @@
 from .models import Image
-from croppy.fields import CropFieldDescriptor, CropFieldFile
+from croppy import budget, engines, queues, signals, stats
+from croppy.fields import Crop, CropFieldDescriptor, CropFieldFile, CropResize
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db.models.signals import post_save
 from django.test import TestCase
+from django.utils import unittest
+from imagekit.lib import Image as PILImage
+from StringIO import StringIO
+import django
 import os
 import shutil
+import struct
 
 def get_image(filename):
     path = os.path.join(
@@ -20,6 +29,60 @@ def get_image(filename):
 
     return image
                    
+def get_striped_tiff(width, height, rows_per_strip):
+    """
+    Return an uncompressed greyscale TIFF stored in strips of ``rows_per_strip``
+    rows, with pixel values of ``(x + y) % 256``.
+    """
+    strips = (height + rows_per_strip - 1) // rows_per_strip
+    arrays = 8 + 2 + 9 * 12 + 4
+    offsets = [arrays + strips * 8 + i * rows_per_strip * width 
+        for i in range(strips)]
+    counts = [min(rows_per_strip, height - i * rows_per_strip) * width 
+        for i in range(strips)]
+    tags = [(256, 4, 1, width), (257, 4, 1, height), (258, 3, 1, 8), 
+        (259, 3, 1, 1), (262, 3, 1, 1), (273, 4, strips, arrays), 
+        (277, 3, 1, 1), (278, 4, 1, rows_per_strip), 
+        (279, 4, strips, arrays + strips * 4)]
+
+    return (struct.pack('<2sHIH', 'II', 42, 8, len(tags)) 
+        + ''.join(struct.pack('<HHII', *tag) for tag in tags)
+        + struct.pack('<I', 0)
+        + struct.pack('<%dI' % strips, *offsets)
+        + struct.pack('<%dI' % strips, *counts)
+        + ''.join(chr((x + y) % 256) for y in range(height) for x in range(width)))
+
+class RecordingQueue(queues.BaseQueue):
+    jobs = []
+
+    def enqueue(self, func, *args):
+        self.jobs.append((func, args))
+
+class RecordingEngine(engines.PILEngine):
+    def __init__(self):
+        self.calls = []
+
+    def open(self, *args, **kwargs):
+        self.calls.append('open')
+        return super(RecordingEngine, self).open(*args, **kwargs)
+
+    def process(self, *args, **kwargs):
+        self.calls.append('process')
+        return super(RecordingEngine, self).process(*args, **kwargs)
+
+    def encode(self, *args, **kwargs):
+        self.calls.append('encode')
+        return super(RecordingEngine, self).encode(*args, **kwargs)
+
+class RecordingSink(stats.BaseSink):
+    metrics = {}
+
+    def timing(self, name, seconds):
+        self.metrics[name] = seconds
+
+    def incr(self, name, value=1):
+        self.metrics[name] = value
+
 class CropsFieldTest(TestCase):
     def setUp(self):
         settings.DEBUG = True
@@ -101,6 +164,14 @@ class CropsFieldTest(TestCase):
                     'filename': 'data.tiff'}}
         
         self.assertRaises(ValidationError, assign)
+
+        # Reserved for the crop data itself
+        for name in ('_pyramid', '_v'):
+            self.assertRaises(ValidationError, self.image.crops.create, name,
+                self.crop)
+
+        spec = {'x': 0, 'y': 0, 'width': 100, 'height': 100, 'filename': 'v.tiff'}
+        self.assertEqual({'_v': spec}, self.image.crops.unpack({'_v': spec}))
         
     def test_iterator_and_length(self):
         self.image.crops.create('square', self.crop)
@@ -124,6 +195,29 @@ class CropsFieldTest(TestCase):
         self.assertEqual(200, self.image.crops.resized_square.width)
         self.assertEqual(200, self.image.crops.resized_square.height)
 
+    def test_metadata_without_storage(self):
+        self.image.crops.create('resized_square', self.crop, resize=(50, 50))
+        
+        path = self.image.crops.resized_square.path
+        size = os.path.getsize(path)
+
+        image = Image.objects.get(id=self.image.id)
+        crop = image.crops.resized_square
+
+        def fail(*args, **kwargs):
+            raise AssertionError("Storage should not be accessed")
+        
+        crop.storage.open = crop.storage.size = fail
+
+        try:
+            self.assertEqual(50, crop.width)
+            self.assertEqual(50, crop.height)
+            self.assertEqual(size, crop.size)
+            self.assertEqual('TIFF', crop.format)
+        finally:
+            del crop.storage.open
+            del crop.storage.size
+
     def test_clearing_all_crops(self):
         self.image.crops.create('square', self.crop)
         self.image.crops.create('rect', self.rect)
@@ -136,6 +230,685 @@ class CropsFieldTest(TestCase):
         self.assertFalse(os.path.exists(square))
         self.assertFalse(os.path.exists(rect))
 
+    def test_create_many(self):
+        opened = []
+        open_source = self.image.crops.open_source
+        
+        def counting_open_source(*args):
+            opened.append(True)
+            return open_source(*args)
+
+        self.image.crops.open_source = counting_open_source
+
+        crops = self.image.crops.create_many({
+            'square': (self.crop, None),
+            'rect': (self.rect, (100, 50))})
+
+        self.assertEqual(1, len(opened))
+        self.assertEqual(set(['square', 'rect']), set(crops.keys()))
+        self.assertEqual(50, self.image.crops.rect.height)
+
+        image = Image.objects.get(id=self.image.id)
+        self.assertTrue(os.path.exists(image.crops.square.path))
+        self.assertTrue(os.path.exists(image.crops.rect.path))
+
+    def test_lazy_loading(self):
+        self.image.crops.create('square', self.crop)
+
+        image = Image.objects.get(id=self.image.id)
+        self.assertFalse('square' in image.crops.__dict__)
+        self.assertEqual(None, image.crops._data)
+
+        # Saving an untouched descriptor writes back the loaded value
+        image.save()
+        image = Image.objects.get(id=self.image.id)
+        self.assertTrue('square' in image.crops.data)
+        self.assertFalse('square' in image.crops.__dict__)
+
+        self.assertIsInstance(image.crops.square, CropFieldFile)
+        self.assertTrue('square' in image.crops.__dict__)
+        self.assertFalse(hasattr(image.crops, 'rect'))
+
+    def test_create_many_in_pool(self):
+        for pool in ('thread', 'process'):
+            self.image.crops.field.workers = 2
+            self.image.crops.field.pool = pool
+            try:
+                self.image.crops.create_many({
+                    'square': (self.crop, None),
+                    'rect': (self.rect, (100, 50))}, force=True)
+            finally:
+                self.image.crops.field.workers = None
+                self.image.crops.field.pool = None
+
+            self.assertTrue(os.path.exists(self.image.crops.square.path))
+            self.assertTrue(os.path.exists(self.image.crops.rect.path))
+            self.assertEqual(100, self.image.crops.square.width)
+            self.assertEqual(50, self.image.crops.rect.height)
+
+    def test_deferred_crop(self):
+        settings.CROPPY_QUEUE = 'tests.app.tests.RecordingQueue'
+        try:
+            crop = self.image.crops.create('square', self.crop, defer=True)
+        finally:
+            del settings.CROPPY_QUEUE
+        
+        self.assertTrue(crop.pending)
+        self.assertFalse(crop.ready)
+        self.assertFalse(os.path.exists(crop.path))
+
+        image = Image.objects.get(id=self.image.id)
+        self.assertTrue(image.crops.square.pending)
+
+        func, args = RecordingQueue.jobs.pop()
+        func(*args)
+
+        image = Image.objects.get(id=self.image.id)
+        self.assertTrue(image.crops.square.ready)
+        self.assertTrue(os.path.exists(image.crops.square.path))
+        self.assertEqual(100, image.crops.square.width)
+
+    def test_invalidate_on_source_change(self):
+        self.image.crops.create('square', self.crop)
+        fingerprint = self.image.crops.square.spec['fingerprint']
+
+        buf = StringIO()
+        PILImage.new('RGB', (300, 300), (255, 0, 0)).save(buf, 'TIFF')
+
+        # Crops are left alone by default
+        image = Image.objects.get(pk=self.image.pk)
+        image.image.save('stale.tiff', ContentFile(buf.getvalue()))
+        self.assertEqual(fingerprint, image.crops.square.spec['fingerprint'])
+        self.assertEqual(['square'], image.crops.get_stale())
+
+        image.crops.field.invalidate = True
+        try:
+            image.image.save('replaced.tiff', ContentFile(buf.getvalue()))
+        finally:
+            image.crops.field.invalidate = False
+
+        crop = Image.objects.get(pk=self.image.pk).crops.square
+        self.assertNotEqual(fingerprint, crop.spec['fingerprint'])
+        self.assertEqual((255, 0, 0), PILImage.open(crop.path).getpixel((0, 0)))
+        self.assertEqual([], image.crops.get_stale())
+
+        image.crops.field.invalidate = 'defer'
+        settings.CROPPY_QUEUE = 'tests.app.tests.RecordingQueue'
+        try:
+            image.image.save('again.tiff', ContentFile(buf.getvalue()))
+        finally:
+            image.crops.field.invalidate = False
+            del settings.CROPPY_QUEUE
+
+        self.assertTrue(image.crops.square.pending)
+        func, args = RecordingQueue.jobs.pop()
+        self.assertEqual(['square'], list(args[-1]))
+
+    def test_regenerate(self):
+        self.image.crops.create('square', self.crop, resize=(50, 50))
+        path = self.image.crops.square.path
+        os.remove(path)
+
+        self.image.crops.regenerate()
+        
+        image = Image.objects.get(id=self.image.id)
+        self.assertEqual(path, image.crops.square.path)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(50, image.crops.square.width)
+
+        # Existing files are replaced only once the new ones were written
+        render = self.image.crops.render
+
+        def failing_render(specs):
+            raise IOError("Storage unavailable")
+
+        self.image.crops.render = failing_render
+        self.assertRaises(IOError, self.image.crops.regenerate)
+        self.assertTrue(os.path.exists(path))
+
+        self.image.crops.render = render
+        self.image.crops.regenerate()
+        self.assertTrue(os.path.exists(self.image.crops.square.path))
+        self.assertNotEqual(path, self.image.crops.square.path)
+        self.assertFalse(os.path.exists(path))
+
+        # Changed field options are applied
+        fingerprint = self.image.crops.square.spec['fingerprint']
+        self.image.crops.field.options = {'format': 'JPEG', 'quality': 50}
+        try:
+            self.image.crops.regenerate()
+        finally:
+            self.image.crops.field.options = {}
+
+        crop = Image.objects.get(id=self.image.id).crops.square
+        self.assertEqual({'format': 'JPEG', 'quality': 50}, crop.spec['options'])
+        self.assertEqual('JPEG', PILImage.open(crop.path).format)
+        self.assertEqual('.jpg', os.path.splitext(crop.name)[1])
+        self.assertNotEqual(fingerprint, crop.spec['fingerprint'])
+
+    def test_regenerate_command(self):
+        self.image.crops.create('square', self.crop)
+        other = get_image('test.tiff')
+        other.crops.create('rect', self.rect)
+
+        os.remove(self.image.crops.square.path)
+        os.remove(other.crops.rect.path)
+
+        checkpoint = os.path.join(settings.MEDIA_ROOT, 'checkpoint.json')
+        stdout = StringIO()
+        call_command('regenerate_crops', 'app.Image', 'crops', chunk_size=1,
+            checkpoint=checkpoint, stdout=stdout)
+
+        self.assertTrue(os.path.exists(self.image.crops.square.path))
+        self.assertTrue(os.path.exists(other.crops.rect.path))
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertTrue('2 rows, 2 crops' in stdout.getvalue())
+
+    def test_delete_many(self):
+        self.image.crops.create('square', self.crop)
+        self.image.crops.create('rect', self.rect)
+        paths = [self.image.crops.square.path, self.image.crops.rect.path]
+
+        storage = self.image.crops.field.storage
+        deleted = []
+
+        def delete_many(names):
+            deleted.extend(names)
+            for name in names:
+                storage.delete(name)
+
+        storage.delete_many = delete_many
+        try:
+            self.image.crops.delete_many(['square', 'rect'])
+        finally:
+            del storage.delete_many
+
+        self.assertEqual(2, len(deleted))
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        
+        image = Image.objects.get(id=self.image.id)
+        self.assertEqual(0, len(image.crops))
+
+    def test_unchanged_crop_is_not_rendered(self):
+        rendered = []
+        render = self.image.crops.render
+
+        def counting_render(specs):
+            rendered.extend(specs.keys())
+            return render(specs)
+
+        self.image.crops.render = counting_render
+
+        self.image.crops.create('square', self.crop)
+        fingerprint = self.image.crops.square.spec['fingerprint']
+
+        self.image.crops.create('square', self.crop)
+        self.assertEqual(['square'], rendered)
+
+        self.image.crops.create('square', self.crop, force=True)
+        self.assertEqual(['square', 'square'], rendered)
+
+        os.remove(self.image.crops.square.path)
+        self.image.crops.create('square', self.crop)
+        self.assertEqual(3, len(rendered))
+        self.assertTrue(os.path.exists(self.image.crops.square.path))
+
+        self.image.crops.create('square', self.crop, lazy=True, force=True)
+        self.assertTrue(self.image.crops.square.pending)
+        self.image.crops.create('square', self.crop)
+        self.assertEqual(4, len(rendered))
+        self.assertTrue(self.image.crops.square.ready)
+
+        self.image.crops.create('square', self.crop, resize=(50, 50))
+        self.assertEqual(5, len(rendered))
+        self.assertNotEqual(fingerprint, 
+            self.image.crops.square.spec['fingerprint'])
+
+    def test_draft_decoding(self):
+        image = Image()
+        buf = StringIO()
+        PILImage.new('RGB', (800, 600), (255, 0, 0)).save(buf, 'JPEG')
+        image.image.save('test.jpg', ContentFile(buf.getvalue()))
+
+        self.assertEqual(4, image.crops.get_reduction({
+            'thumb': {'width': 400, 'height': 400, 'resize': [100, 100]}}))
+
+        img, scale = image.crops.open_image(4)
+        self.assertEqual((200, 150), img.size)
+        self.assertEqual((4.0, 4.0), scale)
+
+        crop = image.crops.create('thumb', (0, 0, 400, 400), resize=(100, 100))
+        self.assertEqual((100, 100), (crop.width, crop.height))
+        self.assertEqual((100, 100), PILImage.open(crop.path).size)
+
+    def test_memory_budget(self):
+        specs = {'square': dict(x=0, y=0, width=100, height=100)}
+        footprint = self.image.crops.get_footprint(specs)
+        self.assertEqual(256 * 256 * 4, footprint)
+
+        # Each worker process gets a copy of the image
+        self.image.crops.field.workers = 2
+        self.image.crops.field.pool = 'process'
+        try:
+            self.assertEqual(footprint, self.image.crops.get_footprint(specs))
+            specs['rect'] = dict(x=100, y=100, width=200, height=100)
+            self.assertEqual(4 * footprint, self.image.crops.get_footprint(specs))
+        finally:
+            self.image.crops.field.workers = None
+            self.image.crops.field.pool = None
+
+        settings.CROPPY_MEMORY_BUDGET = footprint
+        settings.CROPPY_MEMORY_TIMEOUT = 0
+        try:
+            crop = self.image.crops.create('square', self.crop)
+            self.assertTrue(os.path.exists(crop.path))
+            self.assertEqual(0, budget.get_admitted())
+
+            with budget.admit(lambda: 1):
+                self.assertRaises(budget.MemoryBudgetExceeded, 
+                    self.image.crops.create, 'rect', self.rect)
+
+                # A rejected render leaves the crop it would replace alone
+                self.assertRaises(budget.MemoryBudgetExceeded, 
+                    self.image.crops.create, 'square', self.rect)
+                self.assertTrue(os.path.exists(crop.path))
+                self.assertEqual(crop.name, self.image.crops.square.name)
+        finally:
+            del settings.CROPPY_MEMORY_BUDGET
+            del settings.CROPPY_MEMORY_TIMEOUT
+
+        self.assertEqual(0, budget.get_admitted())
+        self.assertFalse('rect' in self.image.crops.data)
+
+    def test_pyramid(self):
+        self.image.crops.field.pyramid = [2, 4]
+        try:
+            crop = self.image.crops.create('full', self.crop)
+            self.assertEqual([], self.image.crops.pyramid)
+
+            crop = self.image.crops.create('thumb', self.crop, resize=(25, 25))
+            self.assertEqual((25, 25), PILImage.open(crop.path).size)
+
+            level = self.image.crops.get_level(
+                {'thumb': self.image.crops.data['thumb']})
+            self.assertEqual(4, level['factor'])
+            self.assertEqual((64, 64), (level['width'], level['height']))
+            self.assertEqual([4.0, 4.0], level['scale'])
+            self.assertEqual(64 * 64 * 4, self.image.crops.get_footprint(
+                {'thumb': self.image.crops.data['thumb']}))
+
+            image = Image.objects.get(pk=self.image.pk)
+            self.assertEqual(self.image.crops.pyramid, image.crops.pyramid)
+            self.assertEqual(set(['full', 'thumb']), set(image.crops.data))
+            self.assertEqual(2, len(image.crops))
+
+            for level in image.crops.pyramid:
+                self.assertTrue(image.crops.field.storage.exists(level['filename']))
+
+            image.crops.delete_pyramid()
+            self.assertEqual([], image.crops.pyramid)
+        finally:
+            self.image.crops.field.pyramid = None
+
+    def test_cached_storage_metadata(self):
+        storage = self.image.crops.field.storage.storage
+        settings.CROPPY_CACHE = 'default'
+        try:
+            crop = self.image.crops.create('square', self.crop)
+            url = crop.url
+            self.assertTrue(crop.storage.exists(crop.name))
+
+            storage.url = storage.exists = None
+            try:
+                self.assertEqual(url, crop.url)
+                self.assertTrue(crop.storage.exists(crop.name))
+            finally:
+                del storage.url
+                del storage.exists
+
+            self.image.crops.delete('square')
+            self.assertFalse(crop.storage.exists(crop.name))
+        finally:
+            del settings.CROPPY_CACHE
+
+    def test_region_decoding(self):
+        image = Image()
+        image.image.save('striped.tiff', ContentFile(get_striped_tiff(200, 300, 10)))
+
+        specs = {'square': {'x': 20, 'y': 105, 'width': 50, 'height': 30}}
+        timer = stats.Timer()
+        with image.crops.open_source(specs, timer) as (img, scale, offset):
+            self.assertEqual((0, 100), offset)
+            self.assertEqual((200, 40), img.size)
+
+        # Reading the strips is told apart from decoding them
+        self.assertTrue('read' in timer.timings)
+        self.assertTrue('decode' in timer.timings)
+        self.assertTrue(timer.counters['bytes_read'] >= 200 * 40)
+
+        self.assertEqual(200 * 40 * 4, image.crops.get_footprint(specs))
+
+        crop = image.crops.create('square', (20, 105, 50, 30))
+        img = PILImage.open(crop.path)
+        self.assertEqual((50, 30), img.size)
+        # imagekit converts greyscale images to RGB before saving
+        self.assertEqual((125, 125, 125), img.getpixel((0, 0)))
+
+        # Crops outside the image intersect no strip, it is loaded in full
+        tiff = PILImage.open(image.image.path)
+        self.assertEqual(None, engines.load_region(tiff, (250, 400, 270, 420)))
+
+        crop = image.crops.create('outside', (250, 400, 20, 20))
+        self.assertEqual((20, 20), PILImage.open(crop.path).size)
+
+    def test_engine(self):
+        field = self.image.crops.field
+        self.assertIsInstance(field.get_engine(), engines.PILEngine)
+
+        settings.CROPPY_ENGINE = 'tests.app.tests.RecordingEngine'
+        try:
+            crop = self.image.crops.create('square', self.crop, resize=(50, 50))
+        finally:
+            del settings.CROPPY_ENGINE
+
+        engine = engines.get_engine('tests.app.tests.RecordingEngine')
+        self.assertEqual(['open', 'process', 'encode'], engine.calls)
+        self.assertEqual((50, 50), PILImage.open(crop.path).size)
+
+    @unittest.skipIf(engines.pyvips is None, "pyvips is not installed")
+    def test_vips_engine(self):
+        self.image.crops.field.engine = 'croppy.engines.VipsEngine'
+        try:
+            crop = self.image.crops.create('rect', self.rect, resize=(100, 50),
+                variants=[50])
+        finally:
+            self.image.crops.field.engine = None
+
+        # The rect reaches past the source's edge and is padded like with PIL
+        img = PILImage.open(crop.path).convert('RGB')
+        self.assertEqual((100, 50), img.size)
+        self.assertEqual((0, 0, 0), img.getpixel((99, 49)))
+        self.assertEqual((50, 25), PILImage.open(
+            crop.storage.path(crop.variants[0]['filename'])).size)
+
+    def test_crop_resize_processor(self):
+        processors = self.image.crops.get_processors(
+            {'x': 100, 'y': 100, 'width': 200, 'height': 100, 'resize': [50, 25]})
+        self.assertEqual(1, len(processors))
+        self.assertIsInstance(processors[0], CropResize)
+
+        img = PILImage.new('RGB', (400, 300))
+        self.assertEqual((50, 25), processors[0].process(img).size)
+
+        # Past the source's edge the crop is padded, not rejected
+        img = PILImage.new('RGB', (400, 300), (255, 255, 255))
+        crop = CropResize(300, 250, 200, 100, (50, 25)).process(img)
+        self.assertEqual((50, 25), crop.size)
+        self.assertEqual((255, 255, 255), crop.getpixel((0, 0)))
+        self.assertEqual((0, 0, 0), crop.getpixel((49, 24)))
+
+        processors = self.image.crops.get_processors(
+            {'x': 100, 'y': 100, 'width': 200, 'height': 100})
+        self.assertIsInstance(processors[0], Crop)
+        self.assertEqual((200, 100), processors[0].process(img).size)
+
+    def test_crop_view(self):
+        crop = self.image.crops.create('square', self.crop, lazy=True)
+        self.assertTrue(crop.pending)
+        self.assertFalse(os.path.exists(crop.path))
+
+        response = self.client.get(crop.view_url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/tiff', response['Content-Type'])
+        self.assertTrue(os.path.exists(crop.path))
+
+        image = Image.objects.get(id=self.image.id)
+        self.assertTrue(image.crops.square.ready)
+        self.assertEqual('"%s"' % image.crops.square.spec['fingerprint'],
+            response['ETag'])
+
+        response = self.client.get(crop.view_url, 
+            HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
+        response = self.client.get(crop.view_url, 
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(304, response.status_code)
+
+        response = self.client.get(crop.view_url.replace('square', 'missing'))
+        self.assertEqual(404, response.status_code)
+
+        # Rendered crops are not rendered again on request
+        os.remove(crop.path)
+        response = self.client.get(crop.view_url)
+        self.assertEqual(404, response.status_code)
+        self.assertFalse(os.path.exists(crop.path))
+
+    def test_versioned_filenames(self):
+        storage = self.image.crops.field.storage.storage
+        probes = []
+
+        def exists(name):
+            probes.append(name)
+            return type(storage).exists(storage, name)
+
+        self.image.crops.field.versioned = True
+        try:
+            # Unique names are written without probing storage
+            storage.exists = exists
+            try:
+                crop = self.image.crops.create('square', self.crop, variants=[50])
+            finally:
+                del storage.exists
+            self.assertEqual([], probes)
+
+            self.assertEqual(8, len(crop.version))
+            self.assertTrue(crop.name.endswith('-square.%s.tiff' % crop.version))
+            self.assertTrue(crop.variants[0]['filename'].endswith(
+                '-square_50w.%s.tiff' % crop.version))
+
+            response = self.client.get(crop.view_url)
+            self.assertTrue('immutable' in response['Cache-Control'])
+
+            response = self.client.get(crop.view_url.split('?')[0])
+            self.assertFalse(response.has_header('Cache-Control'))
+
+            path = crop.path
+            other = self.image.crops.create('square', self.rect)
+            self.assertNotEqual(crop.version, other.version)
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(os.path.exists(other.path))
+        finally:
+            self.image.crops.field.versioned = False
+
+    def test_encoding_options(self):
+        crop = self.image.crops.create('square', self.crop, 
+            options={'format': 'JPEG', 'quality': 50, 'progressive': True})
+
+        self.assertEqual('JPEG', crop.format)
+        self.assertEqual('JPEG', PILImage.open(crop.path).format)
+        self.assertEqual(50, crop.spec['options']['quality'])
+        self.assertEqual('.jpg', os.path.splitext(crop.name)[1])
+
+        self.image.crops.field.options = {'format': 'PNG'}
+        try:
+            crop = self.image.crops.create('rect', self.rect)
+        finally:
+            self.image.crops.field.options = {}
+        
+        self.assertEqual('.png', os.path.splitext(crop.name)[1])
+        self.assertEqual('PNG', PILImage.open(crop.path).format)
+
+    def test_strip_metadata(self):
+        image = Image()
+        buf = StringIO()
+        PILImage.new('RGB', (200, 200)).save(buf, 'PNG', icc_profile='profile')
+        image.image.save('profiled.png', ContentFile(buf.getvalue()))
+
+        crop = image.crops.create('square', self.crop)
+        self.assertFalse('icc_profile' in PILImage.open(crop.path).info)
+
+        crop = image.crops.create('square', self.crop, 
+            options={'strip_metadata': False})
+        self.assertEqual('profile', PILImage.open(crop.path).info['icc_profile'])
+
+    def test_variants(self):
+        crop = self.image.crops.create('rect', self.rect, variants=[50, 100, 150])
+        
+        self.assertEqual([150, 100, 50], [v['width'] for v in crop.variants])
+        self.assertEqual([75, 50, 25], [v['height'] for v in crop.variants])
+
+        paths = [crop.storage.path(v['filename']) for v in crop.variants]
+        for path, variant in zip(paths, crop.variants):
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(variant['width'], PILImage.open(path).size[0])
+
+        self.assertEqual('/test-media/crops/test-rect_50w.tiff 50w, '
+            '/test-media/crops/test-rect_100w.tiff 100w, '
+            '/test-media/crops/test-rect_150w.tiff 150w', crop.srcset)
+
+        self.image.crops.delete('rect')
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+    def test_signals_and_stats(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        signals.crop_created.connect(receiver)
+        signals.crop_deleted.connect(receiver)
+        settings.CROPPY_STATS_SINK = 'tests.app.tests.RecordingSink'
+        try:
+            self.image.crops.create('square', self.crop)
+            self.image.crops.delete('square')
+        finally:
+            signals.crop_created.disconnect(receiver)
+            signals.crop_deleted.disconnect(receiver)
+            del settings.CROPPY_STATS_SINK
+
+        created, deleted = received
+        self.assertEqual(['square'], created['names'])
+        self.assertEqual(self.image, created['instance'])
+        for stage in ('read', 'decode', 'process', 'encode', 'write', 'total'):
+            self.assertTrue(stage in created['timings'])
+        self.assertTrue(created['counters']['bytes_read'] > 0)
+        self.assertTrue(created['counters']['bytes_written'] > 0)
+
+        self.assertEqual(['square'], deleted['names'])
+        self.assertTrue('delete' in deleted['timings'])
+
+        self.assertTrue('croppy.created.decode' in RecordingSink.metrics)
+        self.assertEqual(created['counters']['bytes_written'],
+            RecordingSink.metrics['croppy.created.bytes_written'])
+        self.assertTrue('croppy.deleted.delete' in RecordingSink.metrics)
+
+    def test_batch(self):
+        saves = []
+
+        def receiver(sender, **kwargs):
+            saves.append(kwargs)
+
+        post_save.connect(receiver, sender=Image)
+        try:
+            with self.image.crops.batch():
+                self.image.crops.create('square', self.crop)
+                self.image.crops.create('rect', self.rect)
+                self.image.crops.delete('square')
+                self.assertEqual(0, len(saves))
+        finally:
+            post_save.disconnect(receiver, sender=Image)
+
+        self.assertEqual(1, len(saves))
+
+        image = Image.objects.get(id=self.image.id)
+        self.assertEqual(['rect'], image.crops.data.keys())
+
+    def test_save_only_crops_column(self):
+        if django.VERSION < (1, 5):
+            return
+
+        datetime = Image.objects.get(id=self.image.id).datetime
+        self.image.crops.create('square', self.crop)
+
+        image = Image.objects.get(id=self.image.id)
+        self.assertEqual(datetime, image.datetime)
+        self.assertTrue('square' in image.crops.data)
+
+    def test_compact_serialization(self):
+        self.image.crops.create('square', self.crop, resize=(50, 50))
+        self.image.crops.create('rect', self.rect, variants=[100])
+        data = self.image.crops.data
+
+        self.image.crops.field.compact = True
+        try:
+            self.image.save()
+            raw = Image.objects.filter(id=self.image.id).values_list(
+                'crops', flat=True)[0]
+            image = Image.objects.get(id=self.image.id)
+            self.assertEqual(data, image.crops.data)
+        finally:
+            self.image.crops.field.compact = False
+
+        self.assertTrue('"_v":1' in raw)
+        self.assertFalse('filename' in raw)
+        self.assertFalse('fingerprint' in raw)
+        self.assertFalse('_100w' in raw)
+
+        # Stored filenames don't depend on the source image's current name
+        Image.objects.filter(id=self.image.id).update(image='photos/renamed.tiff')
+        image = Image.objects.get(id=self.image.id)
+        self.assertEqual(data, image.crops.data)
+
+    def test_content_addressed(self):
+        other = Image.objects.create(image=self.image.image.name)
+
+        self.image.crops.field.content_addressed = True
+        try:
+            self.image.crops.create('square', self.crop, variants=[50])
+            other.crops.create('thumb', self.crop, variants=[50])
+
+            self.assertEqual(self.image.crops.square.filenames, 
+                other.crops.thumb.filenames)
+            self.assertEqual(self.image.crops.square.size, other.crops.thumb.size)
+
+            # All files are checked against other rows in one query
+            third = Image.objects.create(image=self.image.image.name)
+            with self.assertNumQueries(1):
+                self.assertEqual([], third.crops.get_unreferenced(
+                    other.crops.thumb.filenames))
+
+            path = self.image.crops.square.path
+
+            # Still referenced by the other instance
+            self.image.crops.delete('square')
+            self.assertTrue(os.path.exists(path))
+
+            other.crops.delete('thumb')
+            self.assertFalse(os.path.exists(path))
+        finally:
+            self.image.crops.field.content_addressed = False
+
+    def test_content_addressed_source_change(self):
+        self.image.crops.field.content_addressed = True
+        self.image.crops.field.invalidate = True
+        try:
+            crop = self.image.crops.create('square', self.crop)
+            path = crop.path
+
+            buf = StringIO()
+            PILImage.new('RGB', (300, 300), (255, 0, 0)).save(buf, 'TIFF')
+            self.image.image.save('replaced.tiff', ContentFile(buf.getvalue()))
+
+            crop = Image.objects.get(pk=self.image.pk).crops.square
+            self.assertNotEqual(path, crop.path)
+            self.assertEqual((255, 0, 0), PILImage.open(crop.path).getpixel((0, 0)))
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual([], self.image.crops.get_stale())
+        finally:
+            self.image.crops.field.content_addressed = False
+            self.image.crops.field.invalidate = False
+
     def test_hyphenated_names(self):
         self.image.crops.create('squared-crop', self.crop)
         self.assertTrue(os.path.exists(self.image.crops.squared_crop.path))
@@ -0,0 +1,225 @@
+"""
+Benchmarks for the crop lifecycle. Images are generated on the fly and a
+throwaway test database and media root are used, so the suite runs offline::
+
+    $ python -m tests.benchmarks --output results.json
+
+Results are written as JSON, one entry per benchmark with the minimum, median
+and mean wall clock time in seconds, so runs of different releases can be
+compared.
+"""
+import os
+import sys
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+from django.conf import settings
+import django
+import json
+import optparse
+import platform
+import shutil
+import tempfile
+import time
+
+
+def measure(func, repeat):
+    """
+    Call ``func`` ``repeat`` times and return the timings in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.time()
+        func()
+        timings.append(time.time() - started)
+    return timings
+
+def summarize(name, params, timings):
+    timings = sorted(timings)
+    return dict(
+        name=name,
+        params=params,
+        repeat=len(timings),
+        min=timings[0],
+        median=timings[len(timings) // 2],
+        mean=sum(timings) / len(timings))
+
+def make_image(size, format):
+    """
+    Return a saved ``Image`` model instance with a noise source image of the
+    given size and format.
+    """
+    from django.core.files.base import ContentFile
+    from imagekit.lib import Image as PILImage, StringIO
+    from tests.app.models import Image
+
+    band = PILImage.effect_noise(size, 64)
+    img = PILImage.merge('RGB', [band, band.rotate(180), band.transpose(PILImage.FLIP_LEFT_RIGHT)])
+
+    buf = StringIO()
+    img.save(buf, format)
+
+    image = Image()
+    image.image.save('bench.%s' % format.lower(), ContentFile(buf.getvalue()))
+    return image
+
+def crop_specs(size, count):
+    """
+    Return ``count`` crop specs spread over an image of the given size, each
+    resized to a third of its width and height.
+    """
+    width, height = size[0] // 2, size[1] // 2
+    specs = {}
+    for i in range(count):
+        x = (size[0] - width) * i // max(count - 1, 1)
+        y = (size[1] - height) * i // max(count - 1, 1)
+        specs['crop_%d' % i] = ((x, y, width, height), (width // 3, height // 3))
+    return specs
+
+def fake_data(count):
+    """
+    Crop data for ``count`` crops without any files, as stored in the
+    database.
+    """
+    return dict(('crop_%d' % i, dict(x=i, y=i, width=100, height=100,
+        resize=[50, 50], filename='crops/bench-crop_%d.jpg' % i,
+        output_width=50, output_height=50, size=2048, format='JPEG',
+        fingerprint='0' * 32)) for i in range(count))
+
+
+def bench_create(options):
+    results = []
+
+    for size in [(640, 480), (2000, 1500), (4000, 3000)]:
+        for format in ['JPEG', 'PNG', 'TIFF']:
+            image = make_image(size, format)
+            params = dict(width=size[0], height=size[1], format=format)
+
+            (spec, resize), = crop_specs(size, 1).values()
+            results.append(summarize('create', params, measure(
+                lambda: image.crops.create('single', spec, resize, force=True),
+                options.repeat)))
+
+            specs = crop_specs(size, 8)
+            results.append(summarize('create_many', dict(params, crops=8), measure(
+                lambda: image.crops.create_many(specs, force=True),
+                options.repeat)))
+
+            image.crops.clear()
+
+    return results
+
+def bench_load(options):
+    from tests.app.models import Image
+
+    results = []
+    data = json.dumps(fake_data(20))
+
+    for _ in range(options.rows):
+        Image.objects.create(image='images/bench.jpg', crops=data)
+
+    def load():
+        list(Image.objects.all())
+
+    def iterate():
+        for image in Image.objects.all():
+            for crop in image.crops:
+                crop.name
+
+    params = dict(rows=options.rows, crops=20)
+    results.append(summarize('load', params, measure(load, options.repeat)))
+    results.append(summarize('iterate', params, measure(iterate, options.repeat)))
+
+    Image.objects.all().delete()
+    return results
+
+def bench_clear(options):
+    image = make_image((2000, 1500), 'JPEG')
+    specs = crop_specs((2000, 1500), 10)
+    timings = []
+
+    for _ in range(options.repeat):
+        image.crops.create_many(specs)
+        timings.extend(measure(image.crops.clear, 1))
+
+    return [summarize('clear', dict(crops=10), timings)]
+
+def bench_json(options):
+    from croppy.fields import CropFieldDescriptor
+    from django.db import connection
+    from tests.app.models import Image
+
+    field = Image._meta.get_field('crops')
+    image = Image()
+    results = []
+
+    for count in [1, 10, 50]:
+        data = fake_data(count)
+        raw = json.dumps(data)
+
+        def dump():
+            field.get_db_prep_value(CropFieldDescriptor(image, field, data),
+                connection=connection, prepared=False)
+
+        def load():
+            CropFieldDescriptor(image, field, raw).data
+
+        params = dict(crops=count)
+        results.append(summarize('get_db_prep_value', params,
+            measure(dump, options.repeat * 10)))
+        results.append(summarize('to_python', params,
+            measure(load, options.repeat * 10)))
+
+    return results
+
+BENCHMARKS = [
+    ('create', bench_create),
+    ('load', bench_load),
+    ('clear', bench_clear),
+    ('json', bench_json),
+]
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('--output', dest='output', default=None,
+        help='File to write JSON results to. Defaults to stdout.')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+        help='Number of times each benchmark is run. Defaults to 5.')
+    parser.add_option('--rows', dest='rows', type='int', default=1000,
+        help='Number of rows for the load benchmarks. Defaults to 1000.')
+    options, names = parser.parse_args(argv)
+
+    media_root = settings.MEDIA_ROOT = tempfile.mkdtemp()
+
+    if hasattr(django, 'setup'):
+        django.setup()
+
+    from django.db import connection
+    import croppy
+
+    connection.creation.create_test_db(verbosity=0)
+
+    results = []
+    try:
+        for name, benchmark in BENCHMARKS:
+            if not names or name in names:
+                results.extend(benchmark(options))
+    finally:
+        shutil.rmtree(media_root)
+
+    output = json.dumps(dict(
+        croppy=croppy.__version__,
+        django=django.get_version(),
+        python=platform.python_version(),
+        results=results), indent=2)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
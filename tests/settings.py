@@ -15,6 +15,8 @@ MEDIA_ROOT = os.path.join(
 
 MEDIA_URL = '/test-media/'
 
+ROOT_URLCONF = 'tests.urls'
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
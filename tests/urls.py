@@ -0,0 +1,9 @@
+try:
+    from django.conf.urls import include, url
+except ImportError:
+    from django.conf.urls.defaults import include, url
+
+
+urlpatterns = [
+    url(r'^crops/', include('croppy.urls')),
+]